@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш ответов OpenAI для текстовых запросов.
+
+Ключ — модель + системный промпт + нормализованный текст пользователя.
+Горячие ответы живут в памяти (LRU, ограничение по байтам, TTL), все — в
+таблице ai_cache в logistics.db, так что кэш переживает перезапуск.
+Опционально включается семантический уровень: эмбеддинг запроса
+сравнивается по косинусу с уже отвеченными, и близкий вопрос получает
+готовый ответ без обращения к чат-модели. Векторы лежат одной матрицей
+float32 (кольцевой буфер на max_vectors строк), поиск — одно умножение
+матрицы на вектор в numpy, доли миллисекунды даже на полном буфере.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS ai_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    embedding BLOB);
+CREATE INDEX IF NOT EXISTS idx_ai_cache_created ON ai_cache(created_at);'''
+
+_GET = "SELECT response, created_at FROM ai_cache WHERE key=?"
+_PUT = ("INSERT OR REPLACE INTO ai_cache (key, model, scope, prompt, response, created_at, embedding) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)")
+_LOAD = "SELECT key, scope, response, created_at, embedding FROM ai_cache WHERE created_at>=? ORDER BY created_at DESC LIMIT ?"
+_PURGE = "DELETE FROM ai_cache WHERE created_at<?"
+_TRIM = "DELETE FROM ai_cache WHERE key IN (SELECT key FROM ai_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)"
+
+_SPACES = re.compile(r"\s+")
+_PUNCT = re.compile(r"[^\w\s]")
+
+
+def normalize(text: str) -> str:
+    """Регистр, ё/е, пунктуация и пробелы не влияют на ключ."""
+    text = _PUNCT.sub(" ", (text or "").lower().replace("ё", "е"))
+    return _SPACES.sub(" ", text).strip()
+
+
+def _scope(model: str, system: str) -> str:
+    return hashlib.sha1(f"{model}\0{system}".encode()).hexdigest()[:16]
+
+
+def _unit(vec) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(vec)) or 1.0
+    return vec / norm
+
+
+class _VectorIndex:
+    """Единичные векторы в одной матрице (кольцо на capacity строк) и их метаданные по номеру строки."""
+
+    def __init__(self, capacity: int, dims: int):
+        self._matrix = np.zeros((capacity, dims), dtype=np.float32)
+        self._scope = np.full(capacity, -1, dtype=np.int32)     # номер scope; -1 — пустая строка
+        self._created = np.zeros(capacity, dtype=np.float64)
+        self._responses = [None] * capacity
+        self._keys = [None] * capacity
+        self._slots = {}                                          # key -> строка
+        self._scope_ids = {}                                      # scope -> номер
+        self._next = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def add(self, key, scope, vec, response, created_at):
+        if vec.shape != self._matrix.shape[1:]: return            # эмбеддинг другой размерности (сменили модель)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._next
+            self._next = (slot + 1) % len(self._keys)
+            old = self._keys[slot]
+            if old is not None: del self._slots[old]             # вытесняем самую старую запись
+            self._keys[slot] = key
+            self._slots[key] = slot
+        self._matrix[slot] = vec
+        self._scope[slot] = self._scope_ids.setdefault(scope, len(self._scope_ids))
+        self._created[slot] = created_at
+        self._responses[slot] = response
+
+    def nearest(self, scope, vec, threshold: float, fresh_after: float):
+        sid = self._scope_ids.get(scope)
+        if sid is None or vec.shape != self._matrix.shape[1:]: return None
+        sims = self._matrix @ vec
+        sims[(self._scope != sid) | (self._created < fresh_after)] = -1.0
+        i = int(np.argmax(sims))
+        return self._responses[i] if sims[i] >= threshold else None
+
+
+class ResponseCache:
+    def __init__(self, db, client=None, max_bytes=4 * 1024 * 1024, ttl=3 * 86400, max_rows=50000,
+                 embed_model=None, embed_dims=256, similarity=0.93, max_vectors=3000):
+        self._db = db
+        self._client = client
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._max_rows = max_rows
+        self._embed_model = embed_model          # None — семантический уровень выключен
+        self._embed_dims = embed_dims
+        self._similarity = similarity
+        self._max_vectors = max_vectors
+        self._mem = OrderedDict()                # key -> (response, created_at)
+        self._mem_bytes = 0
+        self._vectors = _VectorIndex(max_vectors, embed_dims)
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def init_schema(self):
+        self._db.execute_script(SCHEMA)
+
+    async def load(self):
+        """Прогревает память свежими записями из БД и удаляет протухшие (при старте)."""
+        await self._db.execute(_PURGE, (time.time() - self._ttl,))
+        rows = await self._db.fetchall(_LOAD, (time.time() - self._ttl, self._max_vectors))
+        for key, scope, response, created_at, emb in reversed(rows):
+            self._remember(key, response, created_at)
+            if emb and self._embed_model:
+                self._vectors.add(key, scope, np.frombuffer(emb, dtype=np.float32), response, created_at)
+
+    # --- Память ---
+    def _remember(self, key, response, created_at):
+        old = self._mem.pop(key, None)
+        if old: self._mem_bytes -= len(old[0])
+        self._mem[key] = (response, created_at)
+        self._mem_bytes += len(response)
+        while self._mem_bytes > self._max_bytes and self._mem:
+            _, (resp, _) = self._mem.popitem(last=False)
+            self._mem_bytes -= len(resp)
+
+    def _fresh(self, created_at) -> bool:
+        return time.time() - created_at < self._ttl
+
+    # --- API ---
+    @staticmethod
+    def make_key(model: str, system: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{system}\0{normalize(prompt)}".encode()).hexdigest()
+
+    async def get(self, model: str, system: str, prompt: str, semantic: bool = True):
+        """(ответ или None, эмбеддинг запроса или None — пригодится для put).
+
+        semantic=False — только точное совпадение (ключи вида хэша файла эмбеддить бессмысленно).
+        """
+        key = self.make_key(model, system, prompt)
+        item = self._mem.get(key)
+        if item and self._fresh(item[1]):
+            self._mem.move_to_end(key)
+            self.hits += 1
+            return item[0], None
+
+        row = await self._db.fetchone(_GET, (key,))
+        if row and self._fresh(row[1]):
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0], None
+
+        vec = None
+        if semantic and self._embed_model and self._client is not None:
+            vec = await self._embed(prompt)
+            hit = (self._vectors.nearest(_scope(model, system), vec, self._similarity, time.time() - self._ttl)
+                   if vec is not None else None)
+            if hit is not None:
+                self.semantic_hits += 1
+                return hit, vec
+        self.misses += 1
+        return None, vec
+
+    async def put(self, model: str, system: str, prompt: str, response: str, vec=None):
+        if not response: return
+        key, now = self.make_key(model, system, prompt), time.time()
+        scope = _scope(model, system)
+        self._remember(key, response, now)
+        if vec is not None:
+            self._vectors.add(key, scope, vec, response, now)
+        try:
+            await self._db.execute(_PUT, (key, model, scope, normalize(prompt), response, now,
+                                          vec.tobytes() if vec is not None else None))
+        except Exception as e:
+            logging.error(f"AI cache save error: {e}")
+
+    async def purge(self):
+        """Удаляет протухшие записи и держит таблицу в пределах max_rows."""
+        await self._db.execute(_PURGE, (time.time() - self._ttl,))
+        await self._db.execute(_TRIM, (self._max_rows,))
+
+    async def run(self, interval=3600):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"AI cache purge error: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.semantic_hits + self.misses
+        return {
+            "hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / total if total else 0.0,
+            "entries": len(self._mem), "bytes": self._mem_bytes, "vectors": len(self._vectors),
+        }
+
+    # --- Семантический уровень ---
+    async def _embed(self, text):
+        try:
+            res = await self._client.embeddings.create(model=self._embed_model, input=normalize(text),
+                                                       dimensions=self._embed_dims)
+            return _unit(res.data[0].embedding)
+        except Exception as e:
+            logging.error(f"Embedding error: {e}")
+            return None
+
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик запросов к OpenAI.
+
+Все вызовы модели идут через ScheduledOpenAI — обертку с тем же интерфейсом
+(chat.completions.create, embeddings.create), что и AsyncOpenAI:
+  * не больше max_concurrent запросов одновременно (стрим держит слот до конца);
+  * очередь с приоритетами: документы и таможня раньше свободного чата;
+  * у каждого пользователя свой token bucket, частые запросы отклоняются;
+  * 429/5xx/таймауты повторяются с экспоненциальной паузой и jitter,
+    на 429 новые запросы придерживаются до конца паузы.
+Кто и с каким приоритетом спрашивает, проставляет AIRequestMiddleware в
+contextvar, поэтому хендлерам ничего передавать не нужно.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from types import SimpleNamespace
+from typing import Callable, NamedTuple, Optional
+
+import openai
+from aiogram import BaseMiddleware
+
+import metrics
+from ratelimit import TokenBucket
+
+PRIORITY_DOCS = 0
+PRIORITY_CUSTOMS = 1
+PRIORITY_CHAT = 2
+PRIORITY_BACKGROUND = 3     # служебные запросы (сводки диалогов) — только когда нет пользовательских
+
+RETRYABLE = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class AIRequest(NamedTuple):
+    user_id: Optional[int]
+    priority: int
+    on_queue: Optional[Callable] = None      # async (позиция, eta_сек) — показать место в очереди
+
+
+ai_request = contextvars.ContextVar("ai_request", default=AIRequest(None, PRIORITY_CHAT))
+
+
+class RateLimited(Exception):
+    """Пользователь исчерпал лимит запросов к AI."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class AIScheduler:
+    def __init__(self, max_concurrent=8, user_rate=1 / 6, user_burst=5, timeout=60.0,
+                 max_retries=3, base_backoff=1.0, max_backoff=20.0, notify_every=3.0):
+        self._max = max_concurrent
+        self._buckets = TokenBucket(user_rate, user_burst)
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._notify_every = notify_every
+        self._running = 0
+        self._waiters = []                  # heap (priority, seq, future)
+        self._seq = itertools.count()
+        self._paused_until = 0.0            # после 429 — общая пауза
+        self._avg_hold = 8.0                # EWMA длительности запроса, для ETA
+        self.rejected = 0
+        self.retries = 0
+        self.failures = 0
+
+    # --- Слоты ---
+    def _position(self, key) -> int:
+        return 1 + sum(1 for p, s, _ in self._waiters if (p, s) < key)
+
+    async def acquire(self, priority: int, on_queue=None):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if self._running < self._max and not self._waiters:
+            self._running += 1
+            return
+        key = (priority, next(self._seq))
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (*key, fut))
+        try:
+            while True:
+                if on_queue:
+                    pos = self._position(key)
+                    try:
+                        await on_queue(pos, math.ceil(pos * self._avg_hold / self._max))
+                    except Exception as e:
+                        logging.debug(f"Queue notify error: {e}")
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), self._notify_every if on_queue else None)
+                    return          # слот передан нам в release
+                except asyncio.TimeoutError:
+                    continue
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release(0.0)   # слот уже был наш — отдаем следующему
+            else:
+                fut.cancel()
+                self._waiters = [w for w in self._waiters if w[2] is not fut]
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self, held: float):
+        if held:
+            self._avg_hold += 0.2 * (held - self._avg_hold)
+        while self._waiters:
+            *_, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)    # слот переходит ожидающему, счетчик не меняется
+                return
+        self._running -= 1
+
+    # --- Вызовы ---
+    def check_user(self, user_id):
+        if user_id is None: return
+        wait = self._buckets.take(user_id)
+        if wait:
+            self.rejected += 1
+            raise RateLimited(wait)
+
+    async def call(self, fn, *args, limit_user=True, labels=(), **kwargs):
+        """fn(*args, **kwargs) в слоте с повторами. Для stream=True слот держится до конца стрима.
+
+        labels — метки метрик openai_* (эндпоинт, модель).
+        """
+        req = ai_request.get()
+        if limit_user:
+            self.check_user(req.user_id)
+        kwargs.setdefault("timeout", self._timeout)
+        with metrics.timer("openai_queue_seconds"):
+            await self.acquire(req.priority, req.on_queue)
+        started = time.monotonic()
+
+        def done():
+            held = time.monotonic() - started
+            self.release(held)
+            metrics.observe("openai_seconds", labels, held)
+
+        try:
+            result = await self._with_retries(fn, *args, **kwargs)
+        except BaseException:
+            done()
+            raise
+        if kwargs.get("stream"):
+            return _HeldStream(result, done, started, labels)
+        done()
+        metrics.count_usage(kwargs.get("model", ""), getattr(result, "usage", None))
+        return result
+
+    async def _with_retries(self, fn, *args, **kwargs):
+        for attempt in range(self._max_retries + 1):
+            try:
+                return await fn(*args, **kwargs)
+            except RETRYABLE as e:
+                if attempt == self._max_retries:
+                    self.failures += 1
+                    raise
+                delay = min(self._max_backoff, self._base_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                if isinstance(e, openai.RateLimitError):
+                    delay = max(delay, _retry_after(e))
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.retries += 1
+                logging.warning(f"OpenAI {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {"running": self._running, "queued": len(self._waiters), "rejected": self.rejected,
+                "retries": self.retries, "failures": self.failures, "avg_sec": round(self._avg_hold, 1)}
+
+
+class _HeldStream:
+    """Стрим ответа, который отдает слот планировщика, когда дочитан или брошен, и пишет метрики."""
+
+    def __init__(self, stream, on_close, started, labels):
+        self._stream = stream
+        self._iter = stream.__aiter__()
+        self._on_close = on_close
+        self._started = started
+        self._labels = labels
+        self._first = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._iter.__anext__()
+        except BaseException:       # StopAsyncIteration тоже: стрим кончился — слот свободен
+            self._release()
+            raise
+        if self._first:
+            self._first = False
+            metrics.observe("openai_ttft_seconds", self._labels, time.monotonic() - self._started)
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:       # финальный чанк при stream_options.include_usage
+            metrics.count_usage(dict(self._labels).get("model", ""), usage)
+        return chunk
+
+    def _release(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close: on_close()
+
+    async def close(self):
+        self._release()
+        close = getattr(self._stream, "close", None)
+        if close: await close()
+
+
+def _retry_after(e) -> float:
+    try:
+        return float(e.response.headers.get("retry-after", 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+
+class ScheduledOpenAI:
+    """AsyncOpenAI с тем же интерфейсом, но через планировщик (повторы клиента отключены)."""
+
+    def __init__(self, client, scheduler: AIScheduler):
+        self._client = client.with_options(max_retries=0)
+        self.scheduler = scheduler
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    async def _chat(self, **kwargs):
+        if kwargs.get("stream"):
+            kwargs.setdefault("stream_options", {"include_usage": True})   # токены — в последнем чанке
+        labels = (("endpoint", "chat"), ("model", kwargs.get("model", "")))
+        return await self.scheduler.call(self._client.chat.completions.create, labels=labels, **kwargs)
+
+    async def _embed(self, **kwargs):
+        # Эмбеддинг — вспомогательный запрос кэша, в лимит пользователя не считается
+        labels = (("endpoint", "embeddings"), ("model", kwargs.get("model", "")))
+        return await self.scheduler.call(self._client.embeddings.create, limit_user=False, labels=labels, **kwargs)
+
+
+class AIRequestMiddleware(BaseMiddleware):
+    """Проставляет пользователя и приоритет для AI-запросов, перехватывает их ошибки."""
+
+    def __init__(self, priorities: dict):
+        self._priorities = priorities       # префикс состояния FSM -> приоритет
+
+    def _priority(self, raw_state) -> int:
+        for prefix, priority in self._priorities.items():
+            if raw_state and raw_state.startswith(prefix):
+                return priority
+        return PRIORITY_CHAT
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        token = ai_request.set(AIRequest(user.id if user else None, self._priority(data.get("raw_state"))))
+        try:
+            return await handler(event, data)
+        except RateLimited as e:
+            # Ошибку гасим здесь — исход для MetricsMiddleware (она снаружи) передаем через data
+            data[metrics.STATUS_KEY] = "rate_limited"
+            await event.answer(f"⏳ Слишком много запросов к AI. Попробуйте через {math.ceil(e.retry_after)} с.")
+        except (openai.APIError, asyncio.TimeoutError) as e:
+            data[metrics.STATUS_KEY] = "error"
+            # Пользователь уже получил сообщение о недоступности (стрим его ставит сам)
+            logging.warning(f"OpenAI unavailable: {type(e).__name__}: {e}")
+        finally:
+            ai_request.reset(token)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковые ответы AI в Telegram.
+
+Сразу отправляем заглушку, затем читаем стрим OpenAI и правим сообщение
+не чаще min_interval (Telegram режет частые edit_text одного чата), а по
+завершении ставим финальный текст. Длинный ответ переносится в следующее
+сообщение до лимита 4096 символов; ответ из кэша делится на сообщения так
+же. Кэш ответов проверяется до стрима, а готовый текст кладется в него после.
+"""
+import asyncio
+import html
+import logging
+import math
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+from ai_scheduler import RateLimited, ai_request
+
+TG_LIMIT = 4000         # с запасом до 4096 на заголовок и курсор
+CURSOR = " ▌"
+
+
+def _cut(text: str, room: int) -> int:
+    """Сколько символов text влезает в room после html.escape; режем по переносу строки, если он недалеко."""
+    cut = room
+    while len(html.escape(text[:cut])) > room:
+        cut = int(cut * 0.9)
+    newline = text.rfind("\n", 0, cut)
+    if newline > cut // 2: cut = newline
+    return cut
+
+
+def split_text(text: str, header: str = "") -> list:
+    """Части ответа по сообщениям: заголовок — только у первой, каждая в пределах TG_LIMIT."""
+    parts = []
+    while len(header) + len(html.escape(text)) > TG_LIMIT:
+        cut = _cut(text, TG_LIMIT - len(header))
+        parts.append(text[:cut])
+        text, header = text[cut:], ""
+    parts.append(text)
+    return parts
+
+
+class _LiveMessage:
+    """Сообщение, которое дописывается по мере прихода токенов."""
+
+    def __init__(self, anchor: Message, header: str, min_interval: float, min_delta: int):
+        self._anchor = anchor
+        self._header = header
+        self._min_interval = min_interval
+        self._min_delta = min_delta
+        self._msg = None
+        self._offset = 0            # сколько символов ответа уже зафиксировано в прошлых сообщениях
+        self._shown = 0
+        self._last_edit = 0.0
+
+    async def start(self, placeholder: str, message: Message = None):
+        """Показывает заглушку; message — уже отправленная вызывающим заглушка, ее и правим."""
+        self._msg = message or await self._anchor.answer(self._header + placeholder)
+        self._last_edit = time.monotonic()
+
+    async def queued(self, position: int, eta: int):
+        """Место в очереди планировщика AI вместо заглушки."""
+        await self._msg.edit_text(self._header + f"⏳ Вы в очереди: {position}, ожидание ~{eta} с")
+
+    async def _split(self, full: str) -> str:
+        """Переносит в новое сообщение все, что не влезает в текущее; возвращает хвост."""
+        text = full[self._offset:]
+        while len(self._header) + len(html.escape(text)) > TG_LIMIT:
+            cut = _cut(text, TG_LIMIT - len(self._header))
+            await self._edit(text[:cut], force=True)
+            self._offset += cut
+            self._header, self._shown = "", 0
+            self._msg = await self._anchor.answer("⌛")
+            text = full[self._offset:]
+        return text
+
+    async def update(self, full: str):
+        text = await self._split(full)
+        if len(text) - self._shown < self._min_delta: return
+        if time.monotonic() - self._last_edit < self._min_interval: return
+        await self._edit(text, cursor=True)
+
+    async def finish(self, full: str, footer: str = "", reply_markup=None):
+        text = await self._split(full)
+        if reply_markup is not None and not isinstance(reply_markup, InlineKeyboardMarkup):
+            # Обычную клавиатуру через edit не поставить — шлем финал новым сообщением
+            try:
+                await self._msg.delete()
+            except TelegramBadRequest:
+                pass
+            self._msg = await self._anchor.answer(self._header + html.escape(text) + footer, reply_markup=reply_markup)
+            return
+        await self._edit(text, footer=footer, reply_markup=reply_markup, force=True)
+
+    async def _edit(self, text, cursor=False, footer="", reply_markup=None, force=False):
+        body = self._header + (html.escape(text) or "⌛") + (CURSOR if cursor else footer)
+        for _ in range(3 if force else 1):
+            try:
+                await self._msg.edit_text(body, reply_markup=reply_markup)
+                break
+            except TelegramRetryAfter as e:
+                if not force:
+                    self._last_edit = time.monotonic() + e.retry_after  # промежуточную правку просто пропускаем
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "not modified" not in str(e): logging.error(f"Stream edit error: {e}")
+                break
+        self._shown = len(text)
+        self._last_edit = max(self._last_edit, time.monotonic())
+
+
+class StreamingAI:
+    def __init__(self, client, cache=None, min_interval=1.0, min_delta=20):
+        self.client = client
+        self.cache = cache
+        self._min_interval = min_interval
+        self._min_delta = min_delta
+
+    async def stream(self, anchor: Message, messages: list, model="gpt-4o", header="", footer="",
+                     placeholder="⌛ Думаю...", reply_markup=None, message: Message = None, **kwargs) -> str:
+        """Стримит ответ модели в чат. reply_markup может быть функцией от финального текста.
+
+        message — заглушка, которую вызывающий показал заранее (например, до скачивания файла).
+        """
+        live = _LiveMessage(anchor, header, self._min_interval, self._min_delta)
+        await live.start(placeholder, message)
+        text, stream = "", None
+        token = ai_request.set(ai_request.get()._replace(on_queue=live.queued))
+        try:
+            stream = await self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+            async for chunk in stream:
+                if not chunk.choices: continue
+                text += chunk.choices[0].delta.content or ""
+                await live.update(text)
+        except RateLimited as e:
+            await live.finish(f"⏳ Слишком много запросов к AI. Попробуйте через {math.ceil(e.retry_after)} с.")
+            return ""
+        except Exception:
+            if text:
+                await live.finish(text + "\n\n⚠️ Ответ прерван.")
+            else:
+                await live.finish("⚠️ AI сейчас недоступен, попробуйте позже.")
+            raise
+        finally:
+            ai_request.reset(token)
+            if stream is not None and hasattr(stream, "close"):
+                await stream.close()     # отдать соединение и слот планировщика, даже если стрим брошен
+        markup = reply_markup(text) if callable(reply_markup) else reply_markup
+        await live.finish(text, footer, markup)
+        return text
+
+    async def reply_cached(self, anchor: Message, text: str, header="", footer="", reply_markup=None):
+        """Готовый ответ (из кэша) в том же оформлении и с той же разбивкой по сообщениям, что и стрим."""
+        markup = reply_markup(text) if callable(reply_markup) else reply_markup
+        parts = split_text(text, header)
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            await anchor.answer((header if i == 0 else "") + html.escape(part) + (footer if last else ""),
+                                reply_markup=markup if last else None)
+
+    async def answer(self, anchor: Message, system: str, prompt: str, model="gpt-4o", header="", footer="",
+                     reply_markup=None, history=(), **kwargs) -> str:
+        """Ответ на текстовый вопрос: из кэша — сразу, иначе стримом с сохранением в кэш.
+
+        history — предыдущие сообщения диалога; ответ в контексте зависит от них, поэтому кэш не используется.
+        """
+        use_cache = self.cache is not None and not history
+        vec = None
+        if use_cache:
+            cached, vec = await self.cache.get(model, system, prompt)
+            if cached is not None:
+                await self.reply_cached(anchor, cached, header, footer, reply_markup)
+                return cached
+        messages = [{"role": "system", "content": system}, *history, {"role": "user", "content": prompt}]
+        text = await self.stream(anchor, messages, model=model, header=header, footer=footer,
+                                 reply_markup=reply_markup, **kwargs)
+        if use_cache and text:
+            await self.cache.put(model, system, prompt, text, vec)
+        return text
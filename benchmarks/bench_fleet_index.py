@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк FleetIndex: латентность /near на 10k симулированных водителей.
+
+Водители разбросаны по коридору Китай — Казахстан — Европа; запросы — случайные
+точки с радиусами 50/300/1000 км. Для сравнения — линейный проход по всем.
+
+    python benchmarks/bench_fleet_index.py --drivers 10000 --queries 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geoindex import FleetIndex, haversine_km
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--drivers", type=int, default=10000)
+    ap.add_argument("--queries", type=int, default=2000)
+    args = ap.parse_args()
+
+    rnd = random.Random(42)
+    idx = FleetIndex()
+    points = {}
+    t0 = time.perf_counter()
+    for uid in range(args.drivers):
+        lat, lon = rnd.uniform(30, 56), rnd.uniform(10, 125)
+        idx.update(uid, lat, lon)
+        points[uid] = (lat, lon)
+    print(f"Построение индекса: {(time.perf_counter() - t0) * 1000:.1f} мс на {args.drivers} водителей")
+
+    t0 = time.perf_counter()
+    for _ in range(args.drivers * 10):
+        uid = rnd.randrange(args.drivers)
+        lat, lon = points[uid]
+        idx.update(uid, lat + rnd.uniform(-0.01, 0.01), lon + rnd.uniform(-0.01, 0.01))
+    dt = time.perf_counter() - t0
+    print(f"Обновления позиций: {args.drivers * 10 / dt:,.0f} в секунду")
+
+    for radius in (50, 300, 1000):
+        lat_idx, lat_scan = [], []
+        for _ in range(args.queries):
+            lat, lon = rnd.uniform(30, 56), rnd.uniform(10, 125)
+            s = time.perf_counter()
+            res = idx.near(lat, lon, radius, limit=20)
+            lat_idx.append((time.perf_counter() - s) * 1000)
+
+            s = time.perf_counter()
+            scan = sorted((haversine_km(lat, lon, p_lat, p_lon), uid) for uid, (p_lat, p_lon) in idx_positions(idx))
+            scan = [x for x in scan if x[0] <= radius][:20]
+            lat_scan.append((time.perf_counter() - s) * 1000)
+            assert [r.user_id for r in res] == [uid for _, uid in scan]
+        print(f"r={radius:>4} км: индекс p50 {statistics.median(lat_idx):.3f} мс, p99 {percentile(lat_idx, 0.99):.3f} мс"
+              f" | полный перебор p50 {statistics.median(lat_scan):.2f} мс")
+
+
+def idx_positions(idx):
+    return ((uid, (p[0], p[1])) for uid, p in idx._pos.items())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Микро-бенчмарк доступа к users: «как было» против db.Database + UserRepository.
+
+Каждое «сообщение» повторяет путь /start: регистрация пользователя и чтение
+роли для клавиатуры. Старый вариант открывает sqlite3.connect на каждый шаг
+и блокирует event loop, новый идет через одно WAL-соединение с групповым коммитом.
+
+    python benchmarks/bench_users_repo.py --messages 5000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+from db import Database
+from repository import SCHEMA, UserRepository
+
+
+def now_str():
+    return datetime.now().strftime("%d.%m.%Y %H:%M")
+
+
+async def legacy_message(path, user_id):
+    # Копия старого cmd_start + get_main_kb: два соединения, синхронный commit
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT OR IGNORE INTO users (user_id, username, last_seen) VALUES (?, ?, ?)", (user_id, f"u{user_id}", now_str()))
+    conn.execute("UPDATE users SET last_seen=?, username=? WHERE user_id=?", (now_str(), f"u{user_id}", user_id))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(path)
+    conn.execute("SELECT role FROM users WHERE user_id=?", (user_id,)).fetchone()
+    conn.close()
+
+
+async def repo_message(repo, user_id):
+    await repo.touch_user(user_id, f"u{user_id}", int(time.time()))
+    await repo.get_role(user_id)
+
+
+async def run(name, make_coro, messages, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            await make_coro(i % 10000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(messages)))
+    dt = time.perf_counter() - t0
+    print(f"{name:<28} {messages / dt:>10.0f} сообщ./с   ({dt:.2f} с на {messages})")
+
+
+async def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=3000)
+    ap.add_argument("--concurrency", type=int, default=100)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        conn = sqlite3.connect(legacy_path)
+        conn.executescript(SCHEMA)
+        conn.close()
+        await run("sqlite3.connect на вызов", lambda uid: legacy_message(legacy_path, uid), args.messages, args.concurrency)
+
+        db = Database(os.path.join(tmp, "repo.db"))
+        db.open()
+        repo = UserRepository(db)
+        repo.init_schema()
+        migrations.apply(db)
+        await run("Database + UserRepository", lambda uid: repo_message(repo, uid), args.messages, args.concurrency)
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест бота целиком, без сети.
+
+Синтетические апдейты идут прямо в dp.feed_update — тот же путь, что у
+polling и webhook: middleware, FSM в SQLite, репозиторий, outbox, буфер GPS,
+планировщик AI. Внешние сервисы подменяются на месте: Bot API — сессией
+aiogram в памяти, AsyncOpenAI — клиентом с настраиваемой задержкой и долей
+ошибок, gspread — листами в памяти. База — временный файл.
+
+Сценарии: шторм /start, полная анкета OrderFlow, таможенный калькулятор
+(часть товаров находится в справочнике, остальные идут в AI), поток
+live-локаций от тысяч водителей, диалог с AI-консультантом (уточняющие
+вопросы идут с историей) и анализ документов: фото и PDF скачиваются из
+сессии в памяти, проходят предобработку в пуле процессов и кэш по хэшу
+(один и тот же файл приходит от разных пользователей). Апдейты одного пользователя идут по
+очереди, в обработке одновременно не больше --concurrency (как
+tasks_concurrency_limit у polling).
+
+По каждому сценарию: апдейтов/с, перцентили времени обработки апдейта, лаг
+event loop, пик RSS (и пик аллокаций Python с --tracemalloc). Результат
+сохраняется в JSON и сравнивается с предыдущим прогоном.
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --users 5000 --drivers 3000 --geo-updates 20
+    python benchmarks/loadtest.py --scenarios customs --ai-latency 2 --ai-error-rate 0.05
+"""
+import argparse
+import asyncio
+import glob
+import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+import openai
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SCENARIOS = ("start", "order", "customs", "geo", "chat", "docs")
+
+# Методы Bot API, которые возвращают Message (остальным достаточно True)
+_RETURNS_MESSAGE = {"sendMessage", "editMessageText", "sendLocation", "sendPhoto", "sendDocument"}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def fake_documents(count, seed=3):
+    """count разных файлов: фото-«сканы» (JPEG с шумом) и PDF в 2 страницы, по очереди."""
+    from PIL import Image
+    rnd = random.Random(seed)
+    files = []
+    for i in range(count):
+        if i % 2 == 0:
+            img = Image.effect_noise((2400, 1800), 20 + rnd.randrange(40)).convert("RGB")
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=85)
+            files.append(("jpg", out.getvalue()))
+        else:
+            import pymupdf
+            pdf = pymupdf.open()
+            for page_no in range(2):
+                page = pdf.new_page()
+                page.insert_text((72, 72), f"Invoice {i}-{page_no}\n" + "Item qty price\n" * 40)
+            files.append(("pdf", pdf.tobytes()))
+    return files
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (Linux); на других ОС — пиковый из getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        return 0.0
+
+
+# =========================================================
+# Подмены внешних сервисов
+# =========================================================
+class FakeBotSession(BaseSession):
+    """Bot API в памяти: задержка на вызов и минимальные валидные ответы."""
+
+    def __init__(self, latency=0.03, jitter=0.5, seed=1):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._rnd = random.Random(seed)
+        self.files = {}             # file_id -> содержимое для getFile / скачивания
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self._rnd.uniform(-self.jitter, self.jitter)))
+        result = True
+        if name in _RETURNS_MESSAGE:
+            chat_id = getattr(method, "chat_id", None) or 0
+            result = {"message_id": next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": getattr(method, "text", None) or ""}
+        elif name == "getFile":
+            data = self.files[method.file_id]
+            result = {"file_id": method.file_id, "file_unique_id": method.file_id, "file_size": len(data),
+                      "file_path": f"documents/{method.file_id}"}
+        response = self.check_response(bot=bot, method=method, status_code=200,
+                                       content=json.dumps({"ok": True, "result": result}, ensure_ascii=False))
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        self.calls["download"] += 1
+        data = self.files[url.rsplit("/", 1)[-1]]
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + len(data) / 2 ** 20))     # ~1 МБ за задержку вызова
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    async def close(self):
+        pass
+
+
+class _FakeStream:
+    def __init__(self, words, delay, usage):
+        self._words = words
+        self._delay = delay
+        self._usage = usage
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def _gen(self):
+        for word in self._words:
+            await asyncio.sleep(self._delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))], usage=None)
+        yield SimpleNamespace(choices=[], usage=self._usage)
+
+    async def close(self):
+        pass
+
+
+class FakeOpenAI:
+    """AsyncOpenAI с тем же интерфейсом: время до первого токена, скорость стрима и доля 500-х."""
+
+    _REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+    def __init__(self, latency=0.8, ttft=0.3, error_rate=0.0, tokens=40, seed=2):
+        self.latency = latency
+        self.ttft = min(ttft, latency)
+        self.error_rate = error_rate
+        self.tokens = tokens
+        self.calls = 0
+        self.errors = 0
+        self._rnd = random.Random(seed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def _fail(self):
+        if self._rnd.random() < self.error_rate:
+            self.errors += 1
+            raise openai.InternalServerError("fake 500", response=httpx.Response(500, request=self._REQUEST), body=None)
+
+    async def _chat(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.ttft)
+        self._fail()
+        text = "Вероятный код ТН ВЭД 8507600000, пошлина 0%. " + "слово " * self.tokens
+        usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages if isinstance(m["content"], str)) // 4,
+                                completion_tokens=self.tokens)
+        if stream:
+            words = text.split(" ")
+            return _FakeStream([w + " " for w in words], (self.latency - self.ttft) / len(words), usage)
+        await asyncio.sleep(self.latency - self.ttft)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+    async def _embed(self, model, input, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.ttft)
+        self._fail()
+        rnd = random.Random(input)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[rnd.uniform(-1, 1) for _ in range(64)])])
+
+
+class FakeWorksheet:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = []
+
+    def append_rows(self, rows):
+        time.sleep(self.latency)        # вызывается в потоке SheetsWriter, как настоящий HTTP
+        self.rows.extend(rows)
+        return {"updates": {"updatedRows": len(rows)}}
+
+    def col_values(self, col):
+        return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def get_values(self, a1):
+        first, last = (int(x) for x in a1.split(":"))
+        return self.rows[first - 1:last]
+
+
+class FakeGspread:
+    """Клиент gspread с листами в памяти (open_by_key -> worksheet)."""
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.sheets = {}
+
+    def open_by_key(self, key):
+        return self
+
+    def worksheet(self, name):
+        return self.sheets.setdefault(name, FakeWorksheet(self.latency))
+
+    def get_worksheet(self, index):
+        return self.worksheet(None)
+
+    @property
+    def rows(self) -> int:
+        return sum(len(ws.rows) for ws in self.sheets.values())
+
+
+# =========================================================
+# Синтетические апдейты
+# =========================================================
+class Updates:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def _message(self, uid, **fields):
+        msg = {"message_id": next(self._message_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}
+        msg.update(fields)
+        return msg
+
+    def text(self, uid, text):
+        return {"update_id": next(self._update_ids), "message": self._message(uid, text=text)}
+
+    def callback(self, uid, data):
+        return {"update_id": next(self._update_ids),
+                "callback_query": {"id": str(next(self._update_ids)), "from": self._user(uid), "chat_instance": str(uid),
+                                   "data": data, "message": self._message(uid, text="…")}}
+
+    def location(self, uid, lat, lon):
+        return {"update_id": next(self._update_ids),
+                "message": self._message(uid, location={"latitude": lat, "longitude": lon, "live_period": 28800})}
+
+    def document(self, uid, file_id, unique_id, kind, size):
+        """Фото (kind='jpg') или PDF-файл; unique_id у пересылки тот же, у повторной загрузки — новый."""
+        if kind == "jpg":
+            media = {"photo": [{"file_id": file_id, "file_unique_id": unique_id, "width": 2400, "height": 1800,
+                                "file_size": size}]}
+        else:
+            media = {"document": {"file_id": file_id, "file_unique_id": unique_id, "file_name": f"{file_id}.pdf",
+                                  "mime_type": "application/pdf", "file_size": size}}
+        return {"update_id": next(self._update_ids), "message": self._message(uid, **media)}
+
+    def live_location(self, uid, message_id, lat, lon):
+        msg = self._message(uid, location={"latitude": lat, "longitude": lon, "live_period": 28800},
+                            edit_date=int(time.time()))
+        msg["message_id"] = message_id
+        return {"update_id": next(self._update_ids), "edited_message": msg}
+
+
+def build_scenario(name, args, gen: Updates, tariffs, rnd, files=None):
+    """Список диалогов: каждый — апдейты одного пользователя по порядку.
+
+    files — FakeBotSession.files, куда сценарий docs кладет содержимое отправляемых файлов.
+    """
+    base = {"start": 1_000_000, "order": 2_000_000, "customs": 3_000_000, "geo": 4_000_000, "chat": 5_000_000,
+            "docs": 6_000_000}[name]
+    if name == "start":
+        return [[gen.text(base + i, "/start")] for i in range(args.users)]
+    if name == "order":
+        return [[gen.text(base + i, "/start"), gen.text(base + i, "🚛 Оформить перевозку"),
+                 gen.text(base + i, f"Иванов Иван {i}"), gen.callback(base + i, "country_+7"),
+                 gen.text(base + i, f"999{i:07d}"), gen.text(base + i, "Запчасти"),
+                 gen.text(base + i, "5000"), gen.text(base + i, "Шанхай"), gen.text(base + i, "Мюнхен"),
+                 gen.text(base + i, "120"), gen.text(base + i, "0.8")] for i in range(args.users)]
+    if name == "customs":
+        known = [t.description for t in tariffs] or ["Аккумуляторы литий-ионные"]
+        convs = []
+        for i in range(args.users):
+            # Часть товаров — из справочника (без AI), остальные — из ограниченного набора (AI + кэш)
+            cargo = rnd.choice(known) if rnd.random() < args.known_share else f"Изделие модели {rnd.randrange(args.ai_unique)}"
+            convs.append([gen.text(base + i, "🛡 Таможня"), gen.text(base + i, cargo),
+                          gen.callback(base + i, "setduty_10"), gen.text(base + i, str(rnd.randrange(100, 100000)))])
+        return convs
+    if name == "geo":
+        convs = []
+        for i in range(args.drivers):
+            uid = base + i
+            lat, lon = rnd.uniform(30, 56), rnd.uniform(10, 125)
+            first = gen.location(uid, lat, lon)
+            mid = first["message"]["message_id"]
+            conv = [gen.text(uid, "/start"), first]
+            for _ in range(args.geo_updates):
+                lat, lon = lat + rnd.uniform(-0.01, 0.01), lon + rnd.uniform(-0.01, 0.01)
+                conv.append(gen.live_location(uid, mid, lat, lon))
+            convs.append(conv)
+        return convs
+    if name == "chat":
+        # Первый вопрос из общего набора (кэш), дальше — уточнения в контексте диалога
+        return [[gen.text(base + i, f"Сколько стоит доставка {rnd.randrange(20)} тонн из Китая?")]
+                + [gen.text(base + i, f"А если {k + 2} паллеты и срочно?") for k in range(args.chat_turns - 1)]
+                for i in range(args.users // 4)]
+    if name == "docs":
+        # Разных файлов doc_unique: остальные — повторные загрузки (новый file_unique_id, кэш по sha256)
+        docs = fake_documents(args.doc_unique)
+        convs = []
+        for i in range(args.users // 10):
+            n = rnd.randrange(len(docs))
+            kind, data = docs[n]
+            files[f"doc{n}"] = data
+            # Тот же файл второй раз (повторная загрузка) — ответ из кэша по sha256, без предобработки
+            convs.append([gen.text(base + i, "📄 Анализ документов"),
+                          gen.document(base + i, f"doc{n}", f"u{base + i}", kind, len(data)),
+                          gen.text(base + i, "📄 Анализ документов"),
+                          gen.document(base + i, f"doc{n}", f"u{base + i}r", kind, len(data))])
+        return convs
+    raise ValueError(f"Неизвестный сценарий: {name}")
+
+
+# =========================================================
+# Прогон
+# =========================================================
+class LoopMonitor:
+    """Лаг event loop: насколько sleep(interval) просыпается позже; заодно — пик RSS."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.rss_peak = rss_mb()
+        self._task = None
+
+    async def _run(self):
+        for tick in itertools.count():
+            t = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - t - self.interval))
+            if tick % 10 == 0: self.rss_peak = max(self.rss_peak, rss_mb())
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self.rss_peak = max(self.rss_peak, rss_mb())
+
+
+async def run_scenario(bot_main, name, conversations, concurrency, fakes, trace_memory):
+    dp, bot = bot_main.dp, bot_main.bot
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def feed(update):
+        nonlocal errors
+        async with sem:
+            t = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                errors += 1
+                logging.debug(f"Update {update.update_id} failed: {e}")
+            latencies.append(time.perf_counter() - t)
+
+    async def conversation(updates):
+        for update in updates:
+            await feed(update)
+
+    # Разбор JSON в модели aiogram — до замера: в проде его делает polling/webhook, а не этот цикл
+    conversations = [[Update.model_validate(raw, context={"bot": bot}) for raw in conv] for conv in conversations]
+
+    bot_calls = sum(fakes["bot"].calls.values())
+    ai_calls, sheet_rows = fakes["ai"].calls, fakes["sheets"].rows
+    if trace_memory: tracemalloc.reset_peak()
+    monitor = LoopMonitor()
+    monitor.start()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(conversation(c) for c in conversations))
+    elapsed = time.perf_counter() - t0
+    await monitor.stop()
+
+    ms = lambda s: round(s * 1000, 2)
+    result = {
+        "updates": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {"p50": ms(percentile(latencies, 0.5)), "p95": ms(percentile(latencies, 0.95)),
+                       "p99": ms(percentile(latencies, 0.99)), "max": ms(max(latencies, default=0.0))},
+        "loop_lag_ms": {"p50": ms(percentile(monitor.lags, 0.5)), "p99": ms(percentile(monitor.lags, 0.99)),
+                        "max": ms(max(monitor.lags, default=0.0))},
+        "rss_peak_mb": round(monitor.rss_peak, 1),
+        "bot_api_calls": sum(fakes["bot"].calls.values()) - bot_calls,
+        "openai_calls": fakes["ai"].calls - ai_calls,
+        # Строки Sheets пишет фоновый outbox — к концу сценария часть может быть еще в очереди
+        "sheets_rows": fakes["sheets"].rows - sheet_rows,
+    }
+    if trace_memory:
+        result["py_alloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+    return result
+
+
+def print_result(name, r):
+    lat, lag = r["latency_ms"], r["loop_lag_ms"]
+    print(f"{name:<8} {r['updates']:>7} апд. за {r['seconds']:>6.2f} с  {r['updates_per_sec']:>8.0f} апд/с  "
+          f"p50 {lat['p50']:>7.1f}  p95 {lat['p95']:>7.1f}  p99 {lat['p99']:>7.1f} мс  "
+          f"лаг p99 {lag['p99']:>5.1f} / max {lag['max']:>6.1f} мс  RSS {r['rss_peak_mb']:.0f} МБ"
+          + (f"  ошибок {r['errors']}" if r["errors"] else ""))
+
+
+def compare(current, previous_path, threshold):
+    """Сравнение с прошлым прогоном: падение апд/с или рост p95 больше threshold — регрессия."""
+    with open(previous_path, encoding="utf-8") as f:
+        prev = json.load(f)
+    print(f"\nСравнение с {os.path.basename(previous_path)} ({prev.get('version', '?')}):")
+    skip = {"out", "compare", "threshold", "scenarios"}
+    changed = sorted(k for k, v in current["params"].items() if k not in skip and prev.get("params", {}).get(k) != v)
+    if changed:
+        print(f"   параметры отличаются ({', '.join(changed)}) — сравнение ориентировочное")
+    regressions = 0
+    for name, r in current["scenarios"].items():
+        p = prev.get("scenarios", {}).get(name)
+        if not p: continue
+        d_rate = r["updates_per_sec"] / p["updates_per_sec"] - 1 if p["updates_per_sec"] else 0.0
+        d_p95 = r["latency_ms"]["p95"] / p["latency_ms"]["p95"] - 1 if p["latency_ms"]["p95"] else 0.0
+        bad = d_rate < -threshold or d_p95 > threshold
+        regressions += bad
+        print(f"{'⚠️ ' if bad else '   '}{name:<8} апд/с {d_rate:+.0%}   p95 {d_p95:+.0%}")
+    return regressions
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def load_bot(tmp, args):
+    """Импортирует main с временной БД и подменяет Bot API, OpenAI и gspread."""
+    os.environ.update({
+        "BOT_TOKEN": "123456789:LOADTEST-token_for_offline_runs",
+        "DB_PATH": os.path.join(tmp, "logistics.db"),
+        "OPENAI_API_KEY": "sk-loadtest",
+        "SHEET_ID": "loadtest",
+        "GOOGLE_CREDS_JSON": "{}",
+    })
+    bot_main = importlib.import_module("main")
+    logging.getLogger().setLevel(logging.WARNING)
+    fakes = {
+        "bot": FakeBotSession(latency=args.bot_latency),
+        "ai": FakeOpenAI(latency=args.ai_latency, ttft=args.ai_ttft, error_rate=args.ai_error_rate),
+        "sheets": FakeGspread(latency=args.sheets_latency),
+    }
+    bot_main.bot.session = fakes["bot"]
+    # Клиенты создаются в main при импорте — подменяем уже готовые (авторизация gspread не выполняется)
+    bot_main.ai_client._client = fakes["ai"]
+    bot_main.gs_writer._client = fakes["sheets"]
+    return bot_main, fakes
+
+
+async def main():
+    ap = argparse.ArgumentParser(description="Нагрузочный тест бота с подменой Telegram, OpenAI и Sheets")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"через запятую из {', '.join(SCENARIOS)}")
+    ap.add_argument("--users", type=int, default=2000, help="пользователей в start/order/customs (в chat — четверть, в docs — десятая часть)")
+    ap.add_argument("--drivers", type=int, default=2000)
+    ap.add_argument("--geo-updates", type=int, default=10, help="live-обновлений на водителя")
+    ap.add_argument("--concurrency", type=int, default=200, help="апдейтов в обработке одновременно")
+    ap.add_argument("--bot-latency", type=float, default=0.03, help="с на вызов Bot API")
+    ap.add_argument("--ai-latency", type=float, default=0.8, help="с на полный ответ OpenAI")
+    ap.add_argument("--ai-ttft", type=float, default=0.3, help="с до первого токена")
+    ap.add_argument("--ai-error-rate", type=float, default=0.0, help="доля ответов 500 от OpenAI")
+    ap.add_argument("--ai-unique", type=int, default=100, help="разных товаров вне справочника (остальное — кэш)")
+    ap.add_argument("--doc-unique", type=int, default=8, help="разных файлов в сценарии docs")
+    ap.add_argument("--chat-turns", type=int, default=4, help="вопросов консультанту на пользователя в chat")
+    ap.add_argument("--known-share", type=float, default=0.5, help="доля товаров из справочника ТН ВЭД")
+    ap.add_argument("--sheets-latency", type=float, default=0.2, help="с на append_rows")
+    ap.add_argument("--tracemalloc", action="store_true", help="пик аллокаций Python (медленнее в 2-3 раза)")
+    ap.add_argument("--out", help=f"файл результата (по умолчанию — новый файл в {os.path.relpath(RESULTS_DIR, ROOT)})")
+    ap.add_argument("--compare", help="прошлый результат для сравнения (по умолчанию — последний в каталоге)")
+    ap.add_argument("--threshold", type=float, default=0.15, help="порог регрессии")
+    args = ap.parse_args()
+    names = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+
+    tmp = tempfile.mkdtemp(prefix="loadtest-")
+    try:
+        bot_main, fakes = load_bot(tmp, args)
+        background = await bot_main.on_startup()
+        if args.tracemalloc: tracemalloc.start()
+        rnd, gen = random.Random(42), Updates()
+        report = {"version": git_version(), "timestamp": datetime.now().isoformat(timespec="seconds"),
+                  "python": platform.python_version(), "params": vars(args), "scenarios": {}}
+        for name in names:
+            conversations = build_scenario(name, args, gen, bot_main.tariffs.by_prefix("", limit=len(bot_main.tariffs)), rnd,
+                                           files=fakes["bot"].files)
+            result = await run_scenario(bot_main, name, conversations, args.concurrency, fakes, args.tracemalloc)
+            report["scenarios"][name] = result
+            print_result(name, result)
+        report["handlers"] = [{"handler": labels.get("handler"), "status": labels.get("status"), "count": n,
+                               "p50_ms": round(p50 * 1000, 2), "p95_ms": round(p95 * 1000, 2), "p99_ms": round(p99 * 1000, 2)}
+                              for labels, n, p50, p95, p99 in bot_main.metrics.summary("handler_seconds", limit=15)]
+        report["bot_api_calls"] = dict(fakes["bot"].calls)
+        report["openai"] = {"calls": fakes["ai"].calls, "errors": fakes["ai"].errors,
+                            **{k: v for k, v in bot_main.ai_scheduler.stats().items() if isinstance(v, (int, float))}}
+        await bot_main.on_shutdown(background)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print("\nСамые медленные хендлеры (p95, мс):")
+    for h in report["handlers"][:8]:
+        print(f"  {h['handler']:<24} {h['count']:>7}  p50 {h['p50_ms']:>7.1f}  p95 {h['p95_ms']:>7.1f}  p99 {h['p99_ms']:>7.1f}")
+
+    previous = args.compare or max(glob.glob(os.path.join(RESULTS_DIR, "*.json")), default=None)
+    out = args.out or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{report['version']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультат: {out}")
+    if previous and os.path.abspath(previous) != os.path.abspath(out):
+        if compare(report, previous, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Рассылка сообщения всем пользователям бота.
+
+Получатели читаются из users страницами по ключу (user_id > последнего),
+так что в памяти не больше одной страницы даже на 100k пользователей.
+Страницу отправляют несколько воркеров через общий RateLimiter: rate ниже
+глобального лимита Bot API (~30 сообщ/с), чтобы обычным ответам бота
+оставался запас; каждому чату уходит одно сообщение, поэтому лимит на чат
+(1 сообщ/с) соблюдается сам. RetryAfter ставит на паузу всю рассылку.
+Заблокировавшие бота помечаются в users и дальше пропускаются. После
+каждой страницы (и при остановке) прогресс пишется в broadcasts — прерванная
+рассылка (перезапуск, остановка админом) продолжается с того же получателя.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from ratelimit import RateLimiter
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL);'''
+
+STATUS_RUNNING = "running"
+STATUS_PAUSED = "paused"
+STATUS_DONE = "done"
+
+_CREATE = "INSERT INTO broadcasts (admin_id, text, status, total, created_at) VALUES (?, ?, ?, ?, ?)"
+_GET = "SELECT id, admin_id, text, total, last_user_id, sent, failed, blocked FROM broadcasts WHERE id=?"
+_CHECKPOINT = "UPDATE broadcasts SET last_user_id=?, sent=?, failed=?, blocked=?, status=?, finished_at=? WHERE id=?"
+_RESUME = "UPDATE broadcasts SET status=? WHERE id=? AND status IN (?, ?)"
+_UNFINISHED = "SELECT id FROM broadcasts WHERE status=? ORDER BY id"
+
+SENT, BLOCKED, FAILED = "sent", "blocked", "failed"
+
+
+class _Run:
+    __slots__ = ("id", "admin_id", "text", "total", "last_user_id", "sent", "failed", "blocked",
+                 "page", "results", "started", "done_at_start", "stop")
+
+    def __init__(self, id, admin_id, text, total, last_user_id=0, sent=0, failed=0, blocked=0):
+        self.id, self.admin_id, self.text, self.total = id, admin_id, text, total
+        self.last_user_id, self.sent, self.failed, self.blocked = last_user_id, sent, failed, blocked
+        self.page, self.results = [], {}    # текущая страница и уже обработанные в ней user_id -> результат
+        self.started = time.monotonic()
+        self.done_at_start = self.done
+        self.stop = False
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked + len(self.results)
+
+    def count(self, result) -> int:
+        return getattr(self, result) + sum(1 for r in self.results.values() if r == result)
+
+    def commit_page(self):
+        """Переносит в итог обработанный префикс страницы; возвращает id заблокировавших.
+
+        Воркеры завершают сообщения не по порядку, а продолжать рассылку можно только
+        с ключа: после остановки посреди страницы повторно уйдут лишь «дырки» (меньше числа воркеров).
+        """
+        blocked = []
+        for uid in self.page:
+            result = self.results.get(uid)
+            if result is None: break
+            setattr(self, result, getattr(self, result) + 1)
+            if result == BLOCKED: blocked.append(uid)
+            self.last_user_id = uid
+        self.page, self.results = [], {}
+        return blocked
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self.done_at_start) / elapsed if elapsed > 1 else 0.0
+
+
+def _fmt_eta(seconds: float) -> str:
+    m = int(seconds // 60)
+    return f"{m // 60} ч {m % 60} мин" if m >= 60 else (f"{m} мин" if m else f"{int(seconds)} с")
+
+
+class Broadcaster:
+    def __init__(self, bot, db, users, rate=20.0, workers=8, page_size=200, progress_every=5.0):
+        self._bot = bot
+        self._db = db
+        self._users = users
+        self._limiter = RateLimiter(rate, burst=workers)
+        self._workers = workers
+        self._page_size = page_size
+        self._progress_every = progress_every
+        self._run: Optional[_Run] = None
+        self._task = None
+
+    def init_schema(self):
+        self._db.execute_script(SCHEMA)
+
+    @property
+    def active(self) -> Optional[_Run]:
+        return self._run
+
+    # --- Управление ---
+    async def start(self, admin_id: int, text: str) -> Optional[int]:
+        """Запускает рассылку; None — другая рассылка еще идет."""
+        if self._run: return None
+        total = await self._users.count_recipients()
+        bid = await self._db.call(lambda conn: conn.execute(
+            _CREATE, (admin_id, text, STATUS_RUNNING, total, time.time())).lastrowid)
+        self._launch(_Run(bid, admin_id, text, total))
+        return bid
+
+    async def resume(self, broadcast_id: int) -> bool:
+        """Продолжает остановленную или прерванную рассылку; завершенную — нет (False)."""
+        if self._run: return False
+        # Устаревшая кнопка «Продолжить» у завершенной рассылки не должна запустить ее заново
+        if await self._db.execute(_RESUME, (STATUS_RUNNING, broadcast_id, STATUS_PAUSED, STATUS_RUNNING)) != 1:
+            return False
+        row = await self._db.fetchone(_GET, (broadcast_id,))
+        if self._run: return False      # двойное нажатие: пока ждали БД, рассылку уже запустил первый вызов
+        self._launch(_Run(*row))
+        return True
+
+    async def resume_unfinished(self):
+        """При старте: продолжает рассылку, прерванную перезапуском."""
+        rows = await self._db.fetchall(_UNFINISHED, (STATUS_RUNNING,))
+        if rows:
+            await self.resume(rows[0][0])
+
+    def stop(self, broadcast_id: int) -> bool:
+        """Останавливает после текущей страницы (прогресс сохраняется, можно продолжить)."""
+        if not self._run or self._run.id != broadcast_id: return False
+        self._run.stop = True
+        return True
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _launch(self, run: _Run):
+        self._run = run
+        self._task = asyncio.create_task(self._execute(run))
+
+    # --- Отправка ---
+    async def _execute(self, run: _Run):
+        status = STATUS_PAUSED
+        report = await self._send_report(run)
+        progress = asyncio.create_task(self._progress_loop(run, report))
+        try:
+            while not run.stop:
+                page = await self._users.recipients_page(run.last_user_id, self._page_size)
+                if not page:
+                    status = STATUS_DONE
+                    break
+                await self._send_page(run, page)
+                await self._save(run, STATUS_RUNNING)
+        except asyncio.CancelledError:
+            status = STATUS_RUNNING     # выключение бота — продолжим при следующем старте
+            raise
+        except Exception as e:
+            logging.error(f"Broadcast #{run.id} error: {e}")
+        finally:
+            progress.cancel()
+            self._run = None
+            await self._save(run, status)
+            await self._edit_report(report, run, status)
+
+    async def _send_page(self, run: _Run, page):
+        run.page, ids = page, iter(page)
+
+        async def worker():
+            for uid in ids:         # общий итератор: каждый id достается ровно одному воркеру
+                run.results[uid] = await self._deliver(uid, run.text)
+
+        await asyncio.gather(*(worker() for _ in range(self._workers)))
+
+    async def _deliver(self, user_id: int, text: str, attempts=5) -> str:
+        for attempt in range(attempts):
+            await self._limiter.wait()
+            try:
+                await self._bot.send_message(user_id, text, disable_web_page_preview=True)
+                return SENT
+            except TelegramRetryAfter as e:
+                # Флуд-контроль общий на бота — притормаживаем всех воркеров
+                self._limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower(): return BLOCKED
+                logging.warning(f"Broadcast to {user_id} failed: {e}")
+                return FAILED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning(f"Broadcast to {user_id} network error: {e}")
+                await asyncio.sleep(2 ** attempt)
+        return FAILED
+
+    async def _save(self, run: _Run, status: str):
+        """Фиксирует обработанную часть страницы: заблокировавших — в users, прогресс — в broadcasts."""
+        blocked = run.commit_page()
+        if blocked:
+            await self._users.mark_blocked(blocked, int(time.time()))
+        finished = time.time() if status == STATUS_DONE else None
+        await self._db.execute(_CHECKPOINT, (run.last_user_id, run.sent, run.failed, run.blocked,
+                                             status, finished, run.id))
+
+    # --- Отчет админу ---
+    def report(self, run: _Run, status: str = STATUS_RUNNING) -> str:
+        pct = run.done / run.total if run.total else 1.0
+        rate = run.rate()
+        head = {STATUS_RUNNING: "📣 <b>РАССЫЛКА</b>", STATUS_PAUSED: "⏸ <b>РАССЫЛКА ОСТАНОВЛЕНА</b>",
+                STATUS_DONE: "✅ <b>РАССЫЛКА ЗАВЕРШЕНА</b>"}[status]
+        lines = [f"{head} #{run.id}", "━━━━━━━━━━━━━━━━━━",
+                 f"📨 Обработано: <b>{run.done}</b> из {run.total} ({min(pct, 1.0):.0%})",
+                 f"✅ Доставлено: {run.count(SENT)} · 🚫 Заблокировали: {run.count(BLOCKED)} · ❌ Ошибки: {run.count(FAILED)}"]
+        if status == STATUS_RUNNING and rate:
+            lines.append(f"⚡ {rate:.1f} сообщ/с · осталось ~{_fmt_eta(max(0, run.total - run.done) / rate)}")
+        return "\n".join(lines)
+
+    def _keyboard(self, run: _Run, status: str):
+        if status == STATUS_RUNNING:
+            button = InlineKeyboardButton(text="⏸ Остановить", callback_data=f"bc_stop:{run.id}")
+        elif status == STATUS_PAUSED:
+            button = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bc_resume:{run.id}")
+        else:
+            return None
+        return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+    async def _send_report(self, run: _Run):
+        try:
+            return await self._bot.send_message(run.admin_id, self.report(run),
+                                                reply_markup=self._keyboard(run, STATUS_RUNNING))
+        except Exception as e:
+            logging.error(f"Broadcast report error: {e}")
+            return None
+
+    async def _edit_report(self, msg, run: _Run, status: str):
+        if msg is None: return
+        try:
+            await msg.edit_text(self.report(run, status), reply_markup=self._keyboard(run, status))
+        except TelegramRetryAfter:
+            pass
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e): logging.error(f"Broadcast report error: {e}")
+
+    async def _progress_loop(self, run: _Run, msg):
+        while True:
+            await asyncio.sleep(self._progress_every)
+            await self._edit_report(msg, run, STATUS_RUNNING)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный доступ к logistics.db.
+
+Одно долгоживущее соединение в режиме WAL живет в выделенном потоке, так что
+event loop никогда не ждет диск. Запись идет через групповой коммит: все
+execute(), пришедшие за несколько миллисекунд, выполняются в одной транзакции,
+а каждый вызывающий получает свой rowcount после COMMIT. SQL-строки
+держим константами — sqlite3 кэширует подготовленные выражения по тексту запроса.
+"""
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+class Database:
+    def __init__(self, path, commit_interval=0.002, max_batch=500):
+        self.path = path
+        self._commit_interval = commit_interval
+        self._max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self._pending = []          # [(sql, params, many, future), ...]
+        self._flush_task = None     # отложенный коммит (еще ждет commit_interval)
+        self._inflight = set()      # все запущенные коммиты — их дожидается flush()
+
+    def open(self):
+        """Открывает соединение (синхронно, при старте до запуска хендлеров)."""
+        if self._conn is not None: return
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+
+    def execute_script(self, sql: str):
+        """DDL при старте: выполняется синхронно, до запуска event loop-нагрузки."""
+        self._conn.executescript(sql)
+
+    def columns(self, table: str) -> set:
+        """Имена колонок таблицы (синхронно, при старте — для ALTER TABLE в init_schema)."""
+        return {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+
+    @property
+    def user_version(self) -> int:
+        """Версия схемы (PRAGMA user_version), ее ведет migrations.apply."""
+        return self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, version: int, fn):
+        """fn(conn) и новая user_version одной транзакцией (синхронно, при старте).
+
+        Упавшая миграция откатывается целиком, версия не меняется — следующий старт повторит ее.
+        """
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            fn(conn)
+            conn.execute(f"PRAGMA user_version={int(version)}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --- Чтение ---
+    async def fetchone(self, sql, params=()):
+        return await self.call(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.call(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def call(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке БД. Отложенные записи уходят раньше — читаем свои же записи."""
+        if self._pending:
+            await self._flush_now()
+        loop = asyncio.get_running_loop()
+        with metrics.timer("db_seconds", (("op", "query"),)):
+            return await loop.run_in_executor(self._executor, fn, self._conn, *args)
+
+    async def transaction(self, fn, *args):
+        """fn(conn, *args) внутри собственной транзакции (для многошаговых операций)."""
+        def run(conn):
+            conn.execute("BEGIN")
+            try:
+                result = fn(conn, *args)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        return await self.call(run)
+
+    # --- Запись (групповой коммит) ---
+    def execute(self, sql, params=()) -> asyncio.Future:
+        """Ставит запрос в ближайший групповой коммит. Future вернет rowcount после COMMIT."""
+        return self._enqueue(sql, params, False)
+
+    def executemany(self, sql, seq_of_params) -> asyncio.Future:
+        return self._enqueue(sql, list(seq_of_params), True)
+
+    async def flush(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._pending:
+            await self._flush_now()
+        # Коммиты, запущенные полным пакетом или таймером, могут еще идти в потоке БД
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+    def _enqueue(self, sql, params, many):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, params, many, fut))
+        if len(self._pending) >= self._max_batch:
+            self._track(asyncio.create_task(self._flush_now()))
+        elif self._flush_task is None:
+            self._flush_task = self._track(asyncio.create_task(self._flush_later()))
+        return fut
+
+    def _track(self, task):
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        return task
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._commit_interval)
+        self._flush_task = None
+        await self._flush_now()
+
+    async def _flush_now(self):
+        batch, self._pending = self._pending, []
+        if not batch: return
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self._executor, self._commit_batch, batch)
+        except Exception as e:
+            for *_, fut in batch:
+                if not fut.done(): fut.set_exception(e)
+            return
+        for (*_, fut), res in zip(batch, results):
+            if fut.done(): continue
+            if isinstance(res, Exception): fut.set_exception(res)
+            else: fut.set_result(res)
+
+    def _commit_batch(self, batch):
+        conn = self._conn
+        results = []
+        start = time.perf_counter()
+        conn.execute("BEGIN")
+        try:
+            for sql, params, many, _ in batch:
+                # Ошибка одного запроса не откатывает остальные: SQLite откатывает только сам statement
+                try:
+                    cur = conn.executemany(sql, params) if many else conn.execute(sql, params)
+                    results.append(cur.rowcount)
+                except sqlite3.Error as e:
+                    results.append(e)
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+        metrics.observe("db_seconds", (("op", "commit"),), time.perf_counter() - start)
+        metrics.inc("db_commit_statements", (), len(batch))
+        return results
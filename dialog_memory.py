@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Память диалога AI-консультанта.
+
+У каждого пользователя — кольцевой буфер последних реплик (deque с maxlen) и
+краткая сводка всего, что было раньше. Когда реплик становится больше
+max_turns, самые старые сворачиваются в сводку фоновым запросом к модели
+(через планировщик с низшим приоритетом и без лимита пользователя) —
+пользователь ответа не ждет. Если сводка не успевает, буфер все равно не
+растет дальше своего maxlen: старейшие реплики просто выпадают.
+
+Перед запросом история обрезается по бюджету токенов: сводка плюс столько
+последних реплик, сколько влезает. Токены оцениваются по длине текста —
+точный токенайзер здесь не нужен, важна верхняя граница.
+
+Диалоги живут только в памяти: общий лимит на число пользователей и на
+объем текста, при превышении выбрасываются давно молчавшие (LRU). Диалог,
+простаивавший дольше ttl, начинается заново.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import List
+
+from ai_scheduler import PRIORITY_BACKGROUND, AIRequest, ai_request
+
+CHARS_PER_TOKEN = 3          # кириллица в токенайзерах GPT-4o — около 3 символов на токен
+MESSAGE_OVERHEAD = 4         # служебные токены на каждое сообщение чата
+
+SUMMARY_PROMPT = ("Ты ведешь краткую сводку диалога клиента с логистом. Обнови сводку, добавив новые реплики. "
+                  "Сохрани факты: груз, маршрут, вес, объем, сроки, бюджет, договоренности и открытые вопросы. "
+                  "Не больше {words} слов, без вступлений.")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD
+
+
+class _Dialog:
+    __slots__ = ("turns", "summary", "updated", "folding", "chars")
+
+    def __init__(self, maxlen: int):
+        self.turns = deque(maxlen=maxlen)   # (role, text)
+        self.summary = ""
+        self.updated = time.monotonic()
+        self.folding = False                # сводка уже строится
+        self.chars = 0                      # объем текста для общего лимита
+
+
+class DialogMemory:
+    def __init__(self, client, model="gpt-4o-mini", max_turns=12, fold_turns=6, token_budget=1200,
+                 max_turn_chars=2000, summary_words=120, max_users=10000, max_chars=8_000_000, ttl=6 * 3600):
+        self._client = client
+        self._model = model
+        self._max_turns = max_turns
+        self._fold_turns = fold_turns
+        self._token_budget = token_budget
+        self._max_turn_chars = max_turn_chars
+        self._summary_words = summary_words
+        self._max_users = max_users
+        self._max_chars = max_chars
+        self._ttl = ttl
+        self._dialogs = OrderedDict()       # user_id -> _Dialog (LRU)
+        self._chars = 0
+        self._tasks = set()
+        self.summaries = 0                  # счетчики для диагностики
+        self.evicted = 0
+
+    # --- Контекст запроса ---
+    def history(self, user_id: int) -> List[dict]:
+        """Сообщения для модели перед текущим вопросом: сводка и последние реплики в пределах бюджета."""
+        d = self._get(user_id)
+        if d is None: return []
+        budget = self._token_budget
+        out = []
+        if d.summary:
+            summary = d.summary[:budget * CHARS_PER_TOKEN]
+            out.append({"role": "system", "content": f"Краткое содержание предыдущего разговора: {summary}"})
+            budget -= estimate_tokens(summary)
+        recent = []
+        for role, text in reversed(d.turns):
+            cost = estimate_tokens(text)
+            if cost > budget: break
+            budget -= cost
+            recent.append({"role": role, "content": text})
+        out.extend(reversed(recent))
+        return out
+
+    def add(self, user_id: int, question: str, answer: str):
+        """Запоминает обмен репликами; при переполнении буфера запускает сворачивание в сводку."""
+        d = self._get(user_id)
+        if d is None:
+            d = _Dialog(self._max_turns * 2)
+            self._dialogs[user_id] = d
+        for turn in (("user", question[:self._max_turn_chars]), ("assistant", answer[:self._max_turn_chars])):
+            if len(d.turns) == d.turns.maxlen:
+                self._resize(d, -len(d.turns[0][1]))     # выпадет из кольца без сводки
+            d.turns.append(turn)
+            self._resize(d, len(turn[1]))
+        d.updated = time.monotonic()
+        self._dialogs.move_to_end(user_id)
+        if len(d.turns) > self._max_turns and not d.folding:
+            d.folding = True
+            task = asyncio.create_task(self._fold(user_id, d))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._evict()
+
+    def forget(self, user_id: int):
+        d = self._dialogs.pop(user_id, None)
+        if d is not None: self._chars -= d.chars
+
+    # --- Внутреннее ---
+    def _get(self, user_id: int):
+        d = self._dialogs.get(user_id)
+        if d is None: return None
+        if time.monotonic() - d.updated > self._ttl:
+            self.forget(user_id)        # разговор давно закончился — старый контекст только мешает
+            return None
+        self._dialogs.move_to_end(user_id)
+        return d
+
+    def _resize(self, d: _Dialog, delta: int):
+        d.chars += delta
+        self._chars += delta
+
+    def _evict(self):
+        while self._dialogs and (len(self._dialogs) > self._max_users or self._chars > self._max_chars):
+            _, d = self._dialogs.popitem(last=False)
+            self._chars -= d.chars
+            self.evicted += 1
+
+    async def _fold(self, user_id: int, d: _Dialog):
+        """Сворачивает старейшие реплики в сводку; при ошибке реплики остаются до следующей попытки."""
+        ai_request.set(AIRequest(None, PRIORITY_BACKGROUND))    # контекст задачи свой — хендлер не затронет
+        try:
+            old = list(d.turns)[:self._fold_turns]
+            lines = "\n".join(f"{'Клиент' if role == 'user' else 'Логист'}: {text}" for role, text in old)
+            res = await self._client.chat.completions.create(
+                model=self._model, max_tokens=self._summary_words * 3,
+                messages=[{"role": "system", "content": SUMMARY_PROMPT.format(words=self._summary_words)},
+                          {"role": "user", "content": f"Сводка: {d.summary or '—'}\n\nНовые реплики:\n{lines}"}])
+            summary = (res.choices[0].message.content or "").strip()
+            if not summary or self._dialogs.get(user_id) is not d: return    # пустой ответ или диалог уже выброшен
+            # Пока ждали модель, кольцо могло сдвинуться — убираем только те реплики, что еще в начале
+            folded = {id(t) for t in old}
+            while d.turns and id(d.turns[0]) in folded:
+                self._resize(d, -len(d.turns.popleft()[1]))
+            self._resize(d, len(summary) - len(d.summary))
+            d.summary = summary
+            self.summaries += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Dialog summary for {user_id} failed: {type(e).__name__}: {e}")
+        finally:
+            d.folding = False
+
+    async def close(self):
+        for task in list(self._tasks): task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
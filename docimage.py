@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Подготовка фото и сканов документов перед отправкой в vision-модель.
+
+Декодирование и пережатие картинки — чистый CPU, поэтому все делается в
+пуле процессов, а event loop только ждет результат. Фото разворачивается
+по EXIF, обрезаются однотонные поля, размер приводится к тому, что модель
+реально смотрит в режиме detail=high (короткая сторона до 768, длинная до
+2048), и кадр пережимается в JPEG (серый, если документ без цвета). PDF
+рендерится постранично через PyMuPDF сразу в нужном разрешении.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, NamedTuple
+
+from PIL import Image, ImageChops, ImageOps, UnidentifiedImageError
+
+MAX_SHORT = 768         # vision с detail=high ужимает короткую сторону до 768
+MAX_LONG = 2048
+JPEG_QUALITY = 80
+MAX_PAGES = 3           # из PDF берем первые страницы — реквизиты обычно там
+MAX_PIXELS = 60_000_000
+
+KIND_IMAGE = "image"
+KIND_PDF = "pdf"
+
+
+class PreparedDoc(NamedTuple):
+    images: List[bytes]     # JPEG, готовые для image_url
+    bytes_in: int
+    bytes_out: int
+
+    def data_urls(self):
+        return [f"data:image/jpeg;base64,{base64.b64encode(img).decode()}" for img in self.images]
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def doc_kind(mime_type: str = None, file_name: str = None):
+    """Тип вложения по mime/расширению: KIND_IMAGE, KIND_PDF или None (не поддерживается)."""
+    mime, name = (mime_type or "").lower(), (file_name or "").lower()
+    if mime == "application/pdf" or name.endswith(".pdf"):
+        return KIND_PDF
+    if mime.startswith("image/") or name.endswith((".jpg", ".jpeg", ".png", ".webp", ".heic", ".tif", ".tiff", ".bmp")):
+        return KIND_IMAGE
+    return None
+
+
+# --- Работа в дочернем процессе (функции верхнего уровня — их можно отправить в пул) ---
+def _scale(w, h) -> float:
+    return min(1.0, MAX_SHORT / min(w, h), MAX_LONG / max(w, h))
+
+
+def _crop_margins(img, threshold=28, min_keep=0.3):
+    """Срезает однотонные поля вокруг документа (цвет фона — по медиане рамки кадра)."""
+    small = img.convert("L")
+    small.thumbnail((256, 256))
+    w, h = small.size
+    px = small.load()
+    border = sorted([px[x, 0] for x in range(w)] + [px[x, h - 1] for x in range(w)]
+                    + [px[0, y] for y in range(h)] + [px[w - 1, y] for y in range(h)])
+    bg = border[len(border) // 2]
+    mask = ImageChops.difference(small, Image.new("L", small.size, bg)).point(lambda v: 255 if v > threshold else 0)
+    box = mask.getbbox()
+    if not box: return img
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    if area < min_keep * w * h or area > 0.95 * w * h:
+        return img      # либо рамка не найдена, либо резать почти нечего
+    kx, ky = img.width / w, img.height / h
+    pad = 4
+    return img.crop((max(0, int(box[0] * kx) - pad), max(0, int(box[1] * ky) - pad),
+                     min(img.width, int(box[2] * kx) + pad), min(img.height, int(box[3] * ky) + pad)))
+
+
+def _is_gray(img, max_saturation=20) -> bool:
+    small = img.convert("RGB")
+    small.thumbnail((128, 128))
+    sat = small.convert("HSV").getchannel("S")
+    return sum(sat.getdata()) / (sat.width * sat.height) < max_saturation
+
+
+def _finish(img) -> bytes:
+    w, h = img.size
+    k = _scale(w, h)
+    if k < 1.0:
+        img = img.resize((max(1, round(w * k)), max(1, round(h * k))), Image.LANCZOS)
+    img = img.convert("L" if img.mode == "L" or _is_gray(img) else "RGB")
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def _prepare_image(data: bytes) -> List[bytes]:
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width * img.height > MAX_PIXELS:
+            raise ValueError("слишком большое изображение")
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8) — в разы быстрее
+        k = _scale(*img.size)
+        img.draft("RGB", (round(img.width * k), round(img.height * k)))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"не удалось прочитать изображение: {e}")
+    return [_finish(_crop_margins(img))]
+
+
+def _prepare_pdf(data: bytes, max_pages: int) -> List[bytes]:
+    import pymupdf      # тяжелая зависимость — грузим только в процессе, которому пришел PDF
+    try:
+        pdf = pymupdf.open(stream=data, filetype="pdf")
+    except Exception as e:
+        raise ValueError(f"не удалось открыть PDF: {e}")
+    images = []
+    with pdf:
+        for page in pdf.pages(0, min(max_pages, pdf.page_count)):
+            # Рендерим сразу в целевом размере (A4 при 72 dpi мельче 768 — масштаб будет > 1)
+            w, h = page.rect.width, page.rect.height
+            k = min(MAX_SHORT / min(w, h), MAX_LONG / max(w, h))
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(k, k), colorspace=pymupdf.csRGB, alpha=False)
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            images.append(_finish(_crop_margins(img)))
+    if not images:
+        raise ValueError("в PDF нет страниц")
+    return images
+
+
+def prepare(data: bytes, kind: str = KIND_IMAGE, max_pages: int = MAX_PAGES) -> List[bytes]:
+    """Байты файла -> список JPEG (по одному на изображение/страницу). ValueError — файл не читается."""
+    if kind == KIND_PDF:
+        return _prepare_pdf(data, max_pages)
+    return _prepare_image(data)
+
+
+class DocumentPreprocessor:
+    def __init__(self, workers=2, max_pages=MAX_PAGES):
+        self._workers = workers
+        self._max_pages = max_pages
+        self._pool = None           # создается при первом документе
+
+    async def prepare(self, data: bytes, kind: str = KIND_IMAGE) -> PreparedDoc:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self._workers)
+        loop = asyncio.get_running_loop()
+        try:
+            images = await loop.run_in_executor(self._pool, prepare, data, kind, self._max_pages)
+        except BrokenProcessPool:
+            # Воркер упал (например, OOM на огромном скане) — следующий документ получит новый пул
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            raise ValueError("обработчик документов перезапущен, попробуйте еще раз")
+        doc = PreparedDoc(images, len(data), sum(map(len, images)))
+        logging.info(f"Doc prepared: {kind}, {doc.bytes_in} -> {doc.bytes_out} bytes, {len(images)} img")
+        return doc
+
+    async def content_hash(self, data: bytes) -> str:
+        """sha256 файла в потоке: на 20 МБ это десятки мс, hashlib при этом отпускает GIL."""
+        return await asyncio.get_running_loop().run_in_executor(None, content_hash, data)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+FSM-хранилище aiogram в SQLite (таблица fsm_state в logistics.db).
+
+Недозаполненные заявки и расчеты переживают перезапуск бота. Чтение идет из
+LRU-кэша в памяти (в том числе «пустые» ключи — FSM-middleware спрашивает
+состояние на каждое сообщение), запись — write-through с коротким окном:
+set_state + update_data одного хендлера сливаются в одну строку, а все
+строки за окно уходят одним executemany в групповой коммит Database.
+Брошенные диалоги старше ttl считаются пустыми и удаляются фоновой чисткой.
+
+Для нескольких процессов бота над одной БД кэш нужно выключить
+(cache_size=0): тогда каждое чтение идет в SQLite.
+"""
+import asyncio
+import copy
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS fsm_state (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at);'''
+
+_GET = "SELECT state, data, updated_at FROM fsm_state WHERE key=?"
+_UPSERT = ("INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+           "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at")
+_DELETE = "DELETE FROM fsm_state WHERE key=?"
+_PURGE = "DELETE FROM fsm_state WHERE updated_at<?"
+
+
+class _Entry:
+    __slots__ = ("state", "data", "updated")
+
+    def __init__(self, state=None, data=None, updated=0.0):
+        self.state = state
+        self.data = data or {}
+        self.updated = updated
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+def _key(key: StorageKey) -> str:
+    return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:"
+            f"{key.business_connection_id or ''}:{key.destiny}")
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, ttl=3 * 86400, cache_size=20000, write_delay=0.05):
+        self._db = db
+        self._ttl = ttl
+        self._cache_size = cache_size
+        self._write_delay = write_delay
+        self._cache = OrderedDict()      # key -> _Entry (LRU)
+        self._dirty = {}                 # key -> _Entry, еще не отданные в БД
+        self._flush_task = None
+
+    def init_schema(self):
+        self._db.execute_script(SCHEMA)
+
+    # --- Кэш ---
+    async def _entry(self, key: str) -> _Entry:
+        entry = self._dirty.get(key) or self._cache.get(key)
+        if entry is None:
+            row = await self._db.fetchone(_GET, (key,))
+            # Пока ждали БД, ключ могли записать — свежая версия важнее прочитанной
+            entry = self._dirty.get(key) or self._cache.get(key)
+            if entry is None:
+                entry = _Entry(row[0], json.loads(row[1]), row[2]) if row else _Entry()
+                self._remember(key, entry)
+        elif key in self._cache:
+            self._cache.move_to_end(key)
+        if not entry.empty and time.time() - entry.updated > self._ttl:
+            entry = _Entry()            # диалог брошен слишком давно — начинаем с чистого листа
+            self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        if not self._cache_size: return
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)   # грязные записи все равно лежат в _dirty до flush
+
+    def _touch(self, key, entry):
+        entry.updated = time.time()
+        self._remember(key, entry)
+        self._dirty[key] = entry
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._write_delay)
+        self._flush_task = None
+        await self._write()
+
+    async def _write(self):
+        if not self._dirty: return
+        batch, self._dirty = self._dirty, {}
+        upserts = [(k, e.state, json.dumps(e.data, ensure_ascii=False, default=str), e.updated)
+                   for k, e in batch.items() if not e.empty]
+        deletes = [(k,) for k, e in batch.items() if e.empty]
+        futures = []
+        if upserts: futures.append(self._db.executemany(_UPSERT, upserts))
+        if deletes: futures.append(self._db.executemany(_DELETE, deletes))
+        for res in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(res, Exception):
+                logging.error(f"FSM storage write error: {res}")
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = _key(key)
+        entry = await self._entry(k)
+        entry.state = state.state if isinstance(state, State) else state
+        self._touch(k, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(_key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = _key(key)
+        entry = await self._entry(k)
+        entry.data = copy.deepcopy(dict(data))
+        self._touch(k, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return copy.deepcopy((await self._entry(_key(key))).data)
+
+    async def close(self) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
+
+    # --- Обслуживание ---
+    async def purge(self):
+        """Удаляет брошенные диалоги из БД и из кэша."""
+        cutoff = time.time() - self._ttl
+        await self._db.execute(_PURGE, (cutoff,))
+        for k in [k for k, e in self._cache.items() if e.updated < cutoff and k not in self._dirty]:
+            del self._cache[k]
+
+    async def run(self, interval=3600):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"FSM storage purge error: {e}")
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Буфер live-локаций с отложенной записью.
+
+Каждое редактирование live-location только перезаписывает последнюю точку
+водителя в словаре, а раз в flush_interval все накопленное уходит в SQLite
+одним executemany. Решение «пора ли писать строку в Sheets» (раз в 3 часа)
+принимается по монотонным часам в памяти, без чтения и парсинга дат из БД.
+"""
+import asyncio
+import logging
+import time
+
+
+class LiveGeoBuffer:
+    def __init__(self, users, flush_interval=5.0, sheets_interval=10800):
+        self._users = users
+        self._flush_interval = flush_interval
+        self._sheets_interval = sheets_interval
+        self._latest = {}        # user_id -> (geo, seen) — последняя точка с прошлого flush
+        self._sheets_at = {}     # user_id -> time.monotonic() последней строки в Sheets
+        self.updates = 0         # счетчики для диагностики
+        self.flushes = 0
+
+    async def load_throttle(self):
+        """Восстанавливает 3-часовой троттлинг Sheets по last_google_update_at из БД (при старте)."""
+        now_wall, now_mono = time.time(), time.monotonic()
+        for user_id, ts in await self._users.google_updates(int(now_wall - self._sheets_interval)):
+            self._sheets_at[user_id] = now_mono - max(0.0, now_wall - ts)
+
+    def push(self, user_id: int, geo: str, seen: int):
+        """O(1): запоминает последнюю точку водителя до ближайшего flush."""
+        self._latest[user_id] = (geo, seen)
+        self.updates += 1
+
+    def should_log_to_sheets(self, user_id: int) -> bool:
+        """True не чаще раза в sheets_interval на водителя.
+
+        Отметка ставится сразу (две точки подряд не дадут две строки); если строку
+        поставить в очередь не удалось, вызывающий снимает ее через sheets_failed.
+        """
+        now = time.monotonic()
+        last = self._sheets_at.get(user_id)
+        if last is not None and now - last < self._sheets_interval:
+            return False
+        self._sheets_at[user_id] = now
+        return True
+
+    def sheets_failed(self, user_id: int):
+        """Строка в Sheets не записана — следующая точка водителя попробует снова, а не через 3 часа."""
+        self._sheets_at.pop(user_id, None)
+
+    @property
+    def pending(self) -> int:
+        return len(self._latest)
+
+    async def flush(self):
+        if not self._latest: return
+        batch, self._latest = self._latest, {}
+        await self._users.update_geo_many([(uid, geo, seen) for uid, (geo, seen) in batch.items()])
+        self.flushes += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Geo buffer flush error: {e}")
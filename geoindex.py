@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Пространственный индекс автопарка в памяти.
+
+Равномерная сетка по градусам: водитель лежит в одной ячейке, а запрос
+«кто рядом» перебирает только ячейки, покрывающие рамку радиуса, и
+досчитывает точное расстояние по гаверсинусу. Обновление позиции — O(1).
+"""
+import math
+import time
+from collections import defaultdict
+from typing import NamedTuple
+
+EARTH_R_KM = 6371.0
+KM_PER_DEG = math.pi * EARTH_R_KM / 180
+
+
+class Nearby(NamedTuple):
+    distance_km: float
+    user_id: int
+    lat: float
+    lon: float
+    updated: float
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_R_KM * math.asin(math.sqrt(a))
+
+
+def parse_geo(text):
+    """'lat,lon' -> (lat, lon) или None."""
+    try:
+        lat, lon = (float(x) for x in str(text).replace(" ", "").split(","))
+    except (TypeError, ValueError):
+        return None
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+
+class FleetIndex:
+    def __init__(self, cell_deg=0.5):
+        self._cell = cell_deg
+        self._lon_cells = int(round(360 / cell_deg))
+        self._cells = defaultdict(set)     # (iy, ix) -> {user_id}
+        self._pos = {}                     # user_id -> (lat, lon, cell, updated)
+
+    def __len__(self):
+        return len(self._pos)
+
+    def _cell_of(self, lat, lon):
+        return int((lat + 90) // self._cell), int((lon + 180) // self._cell) % self._lon_cells
+
+    def update(self, user_id: int, lat: float, lon: float, updated: float = None):
+        cell = self._cell_of(lat, lon)
+        old = self._pos.get(user_id)
+        if old and old[2] != cell:
+            bucket = self._cells[old[2]]
+            bucket.discard(user_id)
+            if not bucket: del self._cells[old[2]]
+        self._cells[cell].add(user_id)
+        self._pos[user_id] = (lat, lon, cell, updated or time.time())
+
+    def remove(self, user_id: int):
+        old = self._pos.pop(user_id, None)
+        if old:
+            bucket = self._cells[old[2]]
+            bucket.discard(user_id)
+            if not bucket: del self._cells[old[2]]
+
+    def get(self, user_id: int):
+        p = self._pos.get(user_id)
+        return Nearby(0.0, user_id, p[0], p[1], p[3]) if p else None
+
+    def near(self, lat: float, lon: float, radius_km: float, limit: int = 20):
+        """Водители в радиусе radius_km, по возрастанию расстояния."""
+        dlat = radius_km / KM_PER_DEG
+        cos_lat = max(math.cos(math.radians(min(89.9, abs(lat) + dlat))), 1e-6)
+        dlon = min(180.0, radius_km / (KM_PER_DEG * cos_lat))
+        iy0, ix0 = self._cell_of(max(-90.0, lat - dlat), lon - dlon)
+        iy1, _ = self._cell_of(min(89.999, lat + dlat), lon)
+        nx = min(self._lon_cells, int(2 * dlon // self._cell) + 2)
+
+        if (iy1 - iy0 + 1) * nx > len(self._cells):
+            # Рамка шире, чем заполненных ячеек — дешевле пройти по непустым ячейкам
+            candidates = (uid for cell, bucket in self._cells.items()
+                          if iy0 <= cell[0] <= iy1 for uid in bucket)
+        else:
+            cells = self._cells
+            candidates = (uid for iy in range(iy0, iy1 + 1) for k in range(nx)
+                          for uid in cells.get((iy, (ix0 + k) % self._lon_cells), ()))
+
+        found = []
+        for uid in candidates:
+            p_lat, p_lon, _, upd = self._pos[uid]
+            d = haversine_km(lat, lon, p_lat, p_lon)
+            if d <= radius_km:
+                found.append(Nearby(d, uid, p_lat, p_lon, upd))
+        found.sort()
+        return found[:limit]
+
+    def latest(self, limit: int = 30):
+        """Последние по времени обновления позиции (для /fleet)."""
+        items = sorted(self._pos.items(), key=lambda kv: kv[1][3], reverse=True)[:limit]
+        return [Nearby(0.0, uid, p[0], p[1], p[3]) for uid, p in items]
+
+    def active_since(self, ts: float) -> int:
+        return sum(1 for p in self._pos.values() if p[3] >= ts)
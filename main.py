@@ -1,24 +1,23 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import os
+import html
 import re
 import logging
 import platform
+import signal
 import sqlite3
-import json
-import base64
-import gspread
-from datetime import datetime
+import time
+from datetime import date, datetime
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
-from google.oauth2.service_account import Credentials
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode, ChatAction
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, 
     InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, FSInputFile
@@ -26,6 +25,26 @@ from aiogram.types import (
 from aiogram.client.default import DefaultBotProperties
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from db import Database
+from repository import UserRepository, ROLE_CLIENT, ROLE_DRIVER
+from sheets import SheetsWriter
+from outbox import SheetsOutbox
+from geo_buffer import LiveGeoBuffer
+from tracks import TrackStore, simplify, track_length_m
+from geoindex import FleetIndex, parse_geo
+from tariffs import TariffIndex
+from ai_cache import ResponseCache
+from ai_stream import StreamingAI
+from ai_scheduler import AIScheduler, ScheduledOpenAI, AIRequestMiddleware, PRIORITY_DOCS, PRIORITY_CUSTOMS
+from fsm_storage import SQLiteStorage
+from broadcast import Broadcaster
+from webhook import WebhookServer
+import metrics
+from docimage import DocumentPreprocessor, doc_kind, KIND_IMAGE
+from stats import ActivityTracker, OrderStats
+from dialog_memory import DialogMemory
+import migrations
+
 # =========================================================
 # 1. КОНФИГУРАЦИЯ И ИНИЦИАЛИЗАЦИЯ
 # =========================================================
@@ -37,14 +56,62 @@ if platform.system() == 'Windows':
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# Инициализация Bot и AI
-bot = Bot(token=os.getenv("BOT_TOKEN"), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
-client_ai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", "").strip())
-
 # Константы
 ADMIN_IDS = [494255577]
 SHEET_ID = os.getenv("SHEET_ID")
+DB_PATH = os.getenv("DB_PATH", "logistics.db")
+RUN_MODE = os.getenv("RUN_MODE", "polling")              # polling | webhook
+MAX_UPDATE_TASKS = int(os.getenv("MAX_UPDATE_TASKS", "200"))  # апдейтов в обработке одновременно
+
+# Одно соединение с logistics.db в отдельном потоке + репозиторий пользователей
+db = Database(DB_PATH)
+# Активные за 24ч/7д считаются в памяти по часовым корзинам, без COUNT по users
+activity = ActivityTracker()
+users = UserRepository(db, activity=activity)
+order_stats = OrderStats(db)
+# Состояния диалогов (FSM) в той же БД — незаконченные заявки переживают перезапуск
+fsm_storage = SQLiteStorage(db, cache_size=int(os.getenv("FSM_CACHE_SIZE", "20000")))
+
+# Инициализация Bot и AI
+bot = Bot(token=os.getenv("BOT_TOKEN"), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+dp = Dispatcher(storage=fsm_storage)
+client_ai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", "").strip())
+# Все запросы к OpenAI — через планировщик: общий лимит параллельности, лимит на пользователя, повторы
+ai_scheduler = AIScheduler(max_concurrent=int(os.getenv("AI_MAX_CONCURRENT", "8")))
+ai_client = ScheduledOpenAI(client_ai, ai_scheduler)
+
+# Кэш ответов AI (память + SQLite); семантический уровень — если задана модель эмбеддингов
+ai_cache = ResponseCache(db, ai_client, embed_model=os.getenv("AI_CACHE_EMBED_MODEL") or None)
+# Ответы AI стримом с правкой сообщения по мере генерации
+ai = StreamingAI(ai_client, ai_cache)
+# Память консультанта: последние реплики + сводка старых, в пределах бюджета токенов
+dialogs = DialogMemory(ai_client, model=os.getenv("AI_SUMMARY_MODEL", "gpt-4o-mini"),
+                       token_budget=int(os.getenv("AI_HISTORY_TOKENS", "1200")))
+CONSULTANT_PROMPT = "Ты эксперт Logistics Manager. Доставка из Китая в Европу 18 дней, низкие цены. Предлагай нажать 'Оформить перевозку'."
+CUSTOMS_PROMPT = "Назови только вероятный код ТН ВЭД и ставку пошлины %."
+VISION_PROMPT = "Выпиши Отправителя, Товар и Вес."
+
+# Подготовка фото/PDF для vision в пуле процессов (поворот, обрезка полей, уменьшение)
+docs = DocumentPreprocessor(workers=int(os.getenv("DOC_WORKERS", "2")))
+MAX_DOC_BYTES = 20 * 1024 * 1024     # больше Bot API скачать не даст
+
+# Единый писатель в Google Sheets (авторизация один раз, gspread в пуле потоков)
+gs_writer = SheetsWriter(SHEET_ID, os.getenv("GOOGLE_CREDS_JSON"))
+# Локальная очередь строк для Sheets: заявки и GPS не теряются, если Google недоступен
+outbox = SheetsOutbox(db, gs_writer)
+# Последние точки водителей копятся в памяти и пишутся в БД пакетом раз в несколько секунд
+geo_buffer = LiveGeoBuffer(users)
+# История треков: упрощенные сегменты в таблице positions
+tracks = TrackStore(db)
+# Справочник ТН ВЭД: подсказки кода и ставки без обращения к GPT
+tariffs = TariffIndex.from_csv(os.getenv("TARIFF_CSV", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tnved.csv")))
+TARIFF_CONFIDENCE = 0.6     # ниже или при равных кандидатах — спрашиваем AI, локальные варианты показываем как кнопки
+
+# Рассылка всем пользователям: страницами из БД, под лимит Bot API, с продолжением после перезапуска
+broadcaster = Broadcaster(bot, db, users, rate=float(os.getenv("BROADCAST_RATE", "20")))
+
+# Индекс «кто рядом»: последние позиции водителей в сетке по градусам
+fleet = FleetIndex()
 
 # =========================================================
 # 2. СОСТОЯНИЯ (FSM) — КАРКАС ДИАЛОГОВ
@@ -69,55 +136,94 @@ class CustomsCalc(StatesGroup):
 class Broadcast(StatesGroup):
     waiting_for_text = State()
 
+# Время каждого хендлера (первой — чтобы учитывать и остальные middleware)
+for observer in (dp.message, dp.edited_message, dp.callback_query):
+    observer.middleware(metrics.MetricsMiddleware())
+
+# Приоритет запросов к AI по шагу диалога: документы и таможня раньше свободного чата
+dp.message.middleware(AIRequestMiddleware({
+    OrderFlow.waiting_for_doc_analysis.state: PRIORITY_DOCS,
+    f"{CustomsCalc.__name__}:": PRIORITY_CUSTOMS,
+}))
+
 # =========================================================
 # 3. РАБОТА С ДАННЫМИ (DB & GOOGLE)
 # =========================================================
 def init_db():
-    conn = sqlite3.connect('logistics.db')
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users 
-        (user_id INTEGER PRIMARY KEY, username TEXT, role TEXT DEFAULT 'Клиент', 
-        status TEXT, last_seen TEXT, last_geo TEXT, car_number TEXT, route TEXT, last_google_update TEXT)''')
-    conn.commit()
-    conn.close()
-
-async def get_gs_client():
-    creds_json = os.getenv("GOOGLE_CREDS_JSON")
-    if not creds_json: return None
-    info = json.loads(creds_json)
-    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    creds = Credentials.from_service_account_info(info, scopes=scopes)
-    return gspread.authorize(creds)
-
-async def save_to_google_sheets(row_data: list, sheet_name=None):
-    try:
-        client = await get_gs_client()
-        if not client: return False
-        ss = client.open_by_key(SHEET_ID.strip())
-        sheet = ss.worksheet(sheet_name) if sheet_name else ss.get_worksheet(0)
-        sheet.append_row(row_data)
-        return True
-    except Exception as e:
-        logging.error(f"GS Error: {e}")
-        return False
+    db.open()
+    users.init_schema()
+    outbox.init_schema()
+    tracks.init_schema()
+    ai_cache.init_schema()
+    fsm_storage.init_schema()
+    broadcaster.init_schema()
+    # Изменения схемы поверх исходных таблиц (эпохи вместо текстовых дат, индексы, счетчики)
+    migrations.apply(db)
+
+def save_to_google_sheets(row_data: list, sheet_name=None) -> asyncio.Future:
+    """Ставит строку в пакетную запись. Возвращает awaitable с True/False."""
+    return gs_writer.append(row_data, sheet_name)
+
+async def load_fleet_index():
+    """Строит индекс автопарка из users.last_geo (при старте)."""
+    for user_id, geo, seen in await users.last_positions():
+        point = parse_geo(geo)
+        if not point: continue
+        fleet.update(user_id, *point, updated=seen or 0.0)
+
+async def fleet_lines(items, with_distance: bool) -> list:
+    lines = []
+    for it in items:
+        u = await users.get_profile(it.user_id)
+        name = f"@{u.username}" if u and u.username else str(it.user_id)
+        car = f" ({u.car_number})" if u and u.car_number else ""
+        seen = datetime.fromtimestamp(it.updated).strftime("%d.%m %H:%M") if it.updated else "—"
+        dist = f"<b>{it.distance_km:,.0f} км</b> · " if with_distance else ""
+        lines.append(f"• {dist}{name}{car} · {seen} · <a href=\"https://www.google.com/maps?q={it.lat},{it.lon}\">карта</a>")
+    return lines
+
+async def outbox_report() -> str:
+    st = await outbox.stats()
+    age = int(st['oldest_age'])
+    res = (f"📤 <b>ОЧЕРЕДЬ GOOGLE SHEETS</b>\n"
+           f"━━━━━━━━━━━━━━━━━━\n"
+           f"📦 Ожидают отправки: <b>{st['depth']}</b>\n"
+           f"⏳ Самая старая: <b>{age // 3600}ч {age % 3600 // 60}м {age % 60}с</b>\n"
+           f"🔁 Макс. попыток: {st['max_attempts']}")
+    if st['paused_for']:
+        res += f"\n⛔ Пауза по квоте: {int(st['paused_for'])} с"
+    if not st['configured']:
+        res += "\n⛔ Google Sheets не настроен (SHEET_ID / GOOGLE_CREDS_JSON) — строки ждут настройки"
+    if st['last_error']:
+        res += f"\n⚠️ Последняя ошибка: <code>{html.escape(st['last_error'][:200])}</code>"
+    if st['dead']:
+        res += f"\n💀 Отклонены Sheets и отложены: <b>{st['dead']}</b>"
+        if st['dead_error']:
+            res += f" (<code>{html.escape(st['dead_error'][:200])}</code>)"
+    return res
 
 # =========================================================
 # 4. КЛАВИАТУРЫ
 # =========================================================
-def get_main_kb(user_id: int):
-    conn = sqlite3.connect('logistics.db')
-    row = conn.execute("SELECT role FROM users WHERE user_id=?", (user_id,)).fetchone()
-    role = row[0] if row else "Клиент"
-    conn.close()
-
+def build_main_kb(with_gps: bool):
     btns = [
         [KeyboardButton(text="🚛 Оформить перевозку"), KeyboardButton(text="🛡 Таможня")],
         [KeyboardButton(text="📄 Анализ документов"), KeyboardButton(text="👨‍💼 Менеджер")]
     ]
-    if user_id in ADMIN_IDS or role == "Водитель":
+    if with_gps:
         btns.append([KeyboardButton(text="🚀 Начать рейс (Включить GPS)", request_location=True)])
     return ReplyKeyboardMarkup(keyboard=btns, resize_keyboard=True)
 
+# Вариантов всего два — собираем один раз при старте
+KB_CLIENT = build_main_kb(with_gps=False)
+KB_DRIVER = build_main_kb(with_gps=True)
+
+def get_main_kb(user_id: int):
+    """Клавиатура по роли из кэша репозитория — без обращения к БД."""
+    if user_id in ADMIN_IDS or users.role_of(user_id) == ROLE_DRIVER:
+        return KB_DRIVER
+    return KB_CLIENT
+
 def get_country_kb():
     builder = InlineKeyboardBuilder()
     countries = [("🇨🇳 +86", "+86"), ("🇰🇿 +7", "+7"), ("🇷🇺 +7", "+7"), ("🇧🇾 +375", "+375"), ("🇺🇿 +998", "+998")]
@@ -131,20 +237,10 @@ def get_country_kb():
 @dp.message(Command("start"))
 async def cmd_start(m: Message, state: FSMContext):
     await state.clear()
+    dialogs.forget(m.from_user.id)
     
     # Регистрация или обновление пользователя в БД
-    conn = sqlite3.connect('logistics.db')
-    # Используем INSERT OR IGNORE, чтобы не было ошибок, если колонки status еще нет
-    conn.execute(
-        "INSERT OR IGNORE INTO users (user_id, username, last_seen) VALUES (?, ?, ?)",
-        (m.from_user.id, m.from_user.username, datetime.now().strftime("%d.%m.%Y %H:%M"))
-    )
-    conn.execute(
-        "UPDATE users SET last_seen=?, username=? WHERE user_id=?",
-        (datetime.now().strftime("%d.%m.%Y %H:%M"), m.from_user.username, m.from_user.id)
-    )
-    conn.commit()
-    conn.close()
+    await users.touch_user(m.from_user.id, m.from_user.username)
     
     welcome_text = (
         f"🤝 Здравствуйте, {m.from_user.first_name}!\n\n"
@@ -167,7 +263,10 @@ async def cmd_admin(m: Message):
         return 
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📈 Статистика базы", callback_data="stats_users")],
+        [InlineKeyboardButton(text="📈 Статистика базы", callback_data="stats_users"),
+         InlineKeyboardButton(text="⏱ Метрики", callback_data="metrics_summary")],
+        [InlineKeyboardButton(text="📤 Очередь Google Sheets", callback_data="outbox_stats")],
+        [InlineKeyboardButton(text="📣 Рассылка", callback_data="broadcast_new")],
         [InlineKeyboardButton(text="📋 Тест системы (/demo)", callback_data="run_demo_fast")]
     ])
     await m.answer("🛠 <b>Панель администратора Logistics Manager</b>", reply_markup=kb)
@@ -194,8 +293,10 @@ async def cmd_demo(m: Message):
 
     await bot.send_chat_action(m.chat.id, ChatAction.TYPING)
 
-    success_order = await save_to_google_sheets(order_payload)
-    success_geo = await save_to_google_sheets(geo_payload, "мониторинг водителей")
+    success_order, success_geo = await asyncio.gather(
+        save_to_google_sheets(order_payload),
+        save_to_google_sheets(geo_payload, "мониторинг водителей"),
+    )
 
     res = [
         "✅ <b>РЕЗУЛЬТАТЫ ПРОВЕРКИ:</b>",
@@ -208,12 +309,122 @@ async def cmd_demo(m: Message):
     ]
     await status_msg.edit_text("\n".join(res))
 
+@dp.message(Command("outbox"))
+async def cmd_outbox(m: Message):
+    """Глубина очереди Sheets и возраст самой старой неотправленной строки"""
+    if m.from_user.id not in ADMIN_IDS: return
+    await m.answer(await outbox_report())
+
+@dp.message(Command("role"))
+async def cmd_role(m: Message):
+    """Смена роли админом: /role <user_id> водитель|клиент"""
+    if m.from_user.id not in ADMIN_IDS: return
+    parts = (m.text or "").split()
+    roles = {"водитель": ROLE_DRIVER, "клиент": ROLE_CLIENT}
+    if len(parts) != 3 or not parts[1].isdigit() or parts[2].lower() not in roles:
+        await m.answer("Формат: <code>/role 123456789 водитель</code> или <code>клиент</code>")
+        return
+    role = roles[parts[2].lower()]
+    if await users.set_role(int(parts[1]), role):
+        await m.answer(f"✅ Роль пользователя {parts[1]}: <b>{role}</b>")
+    else:
+        await m.answer("⚠️ Пользователь не найден в базе.")
+
+@dp.message(Command("track"))
+async def cmd_track(m: Message):
+    """Трек водителя: /track <user_id> [часов] или /track <user_id> дд.мм.гггг [дд.мм.гггг]"""
+    if m.from_user.id not in ADMIN_IDS: return
+    parts = (m.text or "").split()[1:]
+    try:
+        user_id = int(parts[0])
+        # Дата — строго дд.мм.гггг: «1.5» — это полтора часа, а не дата
+        if len(parts) > 1 and re.fullmatch(r"\d{2}\.\d{2}\.\d{4}", parts[1]):
+            t_from = datetime.strptime(parts[1], "%d.%m.%Y").timestamp()
+            t_to = datetime.strptime(parts[2], "%d.%m.%Y").timestamp() + 86400 if len(parts) > 2 else t_from + 86400
+        else:
+            t_to = datetime.now().timestamp()
+            t_from = t_to - 3600 * (float(parts[1].replace(",", ".")) if len(parts) > 1 else 24)
+    except (IndexError, ValueError):
+        await m.answer("Формат: <code>/track 123456789 [часов]</code> или <code>/track 123456789 01.03.2025 05.03.2025</code>")
+        return
+
+    points = await tracks.track(user_id, t_from, t_to)
+    if not points:
+        await m.answer("📭 За этот период точек нет.")
+        return
+
+    fmt = lambda ts: datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M")
+    # Для ссылки на карту оставляем не больше 25 опорных точек
+    eps, route = 100.0, simplify(points, 100.0)
+    while len(route) > 25:
+        eps *= 2
+        route = simplify(points, eps)
+    map_url = "https://www.google.com/maps/dir/" + "/".join(f"{lat:.5f},{lon:.5f}" for _, lat, lon in route)
+    await m.answer(
+        f"🗺 <b>ТРЕК ВОДИТЕЛЯ {user_id}</b>\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        f"🕒 {fmt(points[0][0])} → {fmt(points[-1][0])}\n"
+        f"📍 Точек: {len(points)}\n"
+        f"🛣 Пройдено: ~{track_length_m(points) / 1000:,.1f} км\n"
+        f"🏁 Последняя: {points[-1][1]:.5f},{points[-1][2]:.5f}\n\n"
+        f'<a href="{map_url}">Открыть маршрут на карте</a>'
+    )
+
+@dp.message(Command("near"))
+async def cmd_near(m: Message):
+    """Водители рядом с точкой: /near 43.25,76.95 100"""
+    if m.from_user.id not in ADMIN_IDS: return
+    parts = (m.text or "").split()[1:]
+    point = parse_geo(parts[0]) if parts else None
+    try:
+        radius = float(parts[1].replace(",", ".")) if len(parts) > 1 else 100.0
+    except ValueError:
+        point = None
+    if not point or radius <= 0:
+        await m.answer("Формат: <code>/near 43.25,76.95 100</code> (координаты и радиус в км)")
+        return
+
+    found = fleet.near(*point, radius, limit=20)
+    if not found:
+        await m.answer(f"📭 В радиусе {radius:g} км водителей нет.")
+        return
+    lines = await fleet_lines(found, with_distance=True)
+    await m.answer(f"📍 <b>Рядом с {point[0]:.4f},{point[1]:.4f} ({radius:g} км):</b>\n" + "\n".join(lines),
+                   disable_web_page_preview=True)
+
+@dp.message(Command("fleet"))
+async def cmd_fleet(m: Message):
+    """Сводка по автопарку: сколько водителей на карте и последние позиции"""
+    if m.from_user.id not in ADMIN_IDS: return
+    now = datetime.now().timestamp()
+    lines = await fleet_lines(fleet.latest(30), with_distance=False)
+    await m.answer(
+        f"🚚 <b>АВТОПАРК</b>\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        f"📡 С позицией: <b>{len(fleet)}</b> · за час: <b>{fleet.active_since(now - 3600)}</b> · за сутки: <b>{fleet.active_since(now - 86400)}</b>\n\n"
+        + ("\n".join(lines) or "Пока нет ни одной позиции."),
+        disable_web_page_preview=True
+    )
+
+@dp.message(Command("ai_cache"))
+async def cmd_ai_cache(m: Message):
+    """Счетчики кэша ответов AI"""
+    if m.from_user.id not in ADMIN_IDS: return
+    st, sch = ai_cache.stats(), ai_scheduler.stats()
+    await m.answer(
+        f"🧠 <b>КЭШ ОТВЕТОВ AI</b>\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        f"✅ Попадания: <b>{st['hits']}</b> (+ похожие вопросы: {st['semantic_hits']})\n"
+        f"❌ Промахи: <b>{st['misses']}</b>\n"
+        f"📈 Доля попаданий: <b>{st['hit_rate']:.0%}</b>\n"
+        f"🗂 В памяти: {st['entries']} ответов, {st['bytes'] / 1024:.0f} КБ; векторов: {st['vectors']}\n\n"
+        f"🚦 Запросы к OpenAI: выполняется {sch['running']}, в очереди {sch['queued']}, ~{sch['avg_sec']} с на запрос\n"
+        f"🔁 Повторов: {sch['retries']} · ошибок: {sch['failures']} · отклонено по лимиту: {sch['rejected']}"
+    )
+
 @dp.message(Command("driver_2025"))
 async def cmd_driver(m: Message):
-    conn = sqlite3.connect('logistics.db')
-    conn.execute("UPDATE users SET role='Водитель' WHERE user_id=?", (m.from_user.id,))
-    conn.commit()
-    conn.close()
+    await users.set_role(m.from_user.id, ROLE_DRIVER)
     await m.answer("✅ <b>Роль водителя активирована!</b>\nВам доступна кнопка отправки GPS.", reply_markup=get_main_kb(m.from_user.id))
 
 # =========================================================
@@ -271,27 +482,69 @@ async def ord_9(m: Message, state: FSMContext):
 async def ord_10(m: Message, state: FSMContext):
     d = await state.get_data()
     row = ["ЗАКАЗ", datetime.now().strftime("%d.%m.%Y %H:%M"), d['fio'], d['phone'], d['cargo'], d['val'], d['org'], d['dst'], d['w'], m.text, "Срок 18д"]
-    await save_to_google_sheets(row)
-    await m.answer("🚀 Заявка в таблице! Менеджер свяжется.", reply_markup=get_main_kb(m.from_user.id))
+    try:
+        # Ключ из chat_id + message_id: повторная доставка того же апдейта не задвоит заявку
+        added = await outbox.enqueue(row, key=f"order:{m.chat.id}:{m.message_id}")
+    except sqlite3.Error as e:
+        logging.error(f"Outbox enqueue error: {e}")
+        await m.answer("⚠️ Не удалось сохранить заявку, отправьте объем еще раз.")
+        return
+    if added: await order_stats.add()
+    await m.answer("🚀 Заявка принята! Менеджер свяжется.", reply_markup=get_main_kb(m.from_user.id))
     await state.clear()
 
 # =========================================================
-# 7. VISION AI (Base64)
+# 7. VISION AI (фото и PDF, предобработка в пуле процессов)
 # =========================================================
 @dp.message(F.text == "📄 Анализ документов")
 async def vis_1(m: Message, state: FSMContext):
     await state.set_state(OrderFlow.waiting_for_doc_analysis)
-    await m.answer("📸 Пришлите фото документа:")
+    await m.answer("📸 Пришлите фото документа или файл (изображение, PDF):")
 
-@dp.message(OrderFlow.waiting_for_doc_analysis, F.photo)
+@dp.message(OrderFlow.waiting_for_doc_analysis, F.photo | F.document)
 async def vis_2(m: Message, state: FSMContext):
-    await m.answer("⌛ Анализирую...")
-    file = await bot.get_file(m.photo[-1].file_id)
-    p_bytes = await bot.download_file(file.file_path)
-    b64 = base64.b64encode(p_bytes.getvalue()).decode()
-    
-    res = await client_ai.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": [{"type": "text", "text": "Выпиши Отправителя, Товар и Вес."}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}]}] )
-    await m.answer(f"📊 AI Резюме:\n{res.choices[0].message.content}", reply_markup=get_main_kb(m.from_user.id))
+    if m.photo:
+        media, kind = m.photo[-1], KIND_IMAGE
+    else:
+        media, kind = m.document, doc_kind(m.document.mime_type, m.document.file_name)
+        if kind is None:
+            return await m.answer("⚠️ Поддерживаются фото, изображения и PDF.")
+    if media.file_size and media.file_size > MAX_DOC_BYTES:
+        return await m.answer("⚠️ Файл больше 20 МБ, пришлите фото или первые страницы.")
+    header, kb = "📊 AI Резюме:\n", get_main_kb(m.from_user.id)
+    # Заглушка — сразу: скачивание и подготовка большого файла занимают секунды
+    placeholder = await m.answer(header + "⌛ Анализирую...")
+
+    # Тот же файл (пересылка) узнаем по file_unique_id еще до скачивания
+    tg_key = f"tg {media.file_unique_id}"
+    cached, _ = await ai_cache.get("gpt-4o", VISION_PROMPT, tg_key, semantic=False)
+    if cached is None:
+        file = await bot.get_file(media.file_id)
+        data = (await bot.download_file(file.file_path)).getvalue()
+        # ...а повторную загрузку того же содержимого — по хэшу байтов
+        hash_key = f"sha {await docs.content_hash(data)}"
+        cached, _ = await ai_cache.get("gpt-4o", VISION_PROMPT, hash_key, semantic=False)
+    if cached is not None:
+        # Ответ из кэша уходит отдельными сообщениями с клавиатурой — заглушка больше не нужна
+        try:
+            await placeholder.delete()
+        except TelegramBadRequest:
+            pass
+        await ai.reply_cached(m, cached, header, reply_markup=kb)
+        await state.clear()
+        return
+
+    try:
+        doc = await docs.prepare(data, kind)
+    except ValueError as e:
+        logging.warning(f"Doc prepare error: {e}")
+        return await placeholder.edit_text("⚠️ Не удалось прочитать файл, пришлите другое фото.")
+    content = [{"type": "text", "text": VISION_PROMPT}]
+    content += [{"type": "image_url", "image_url": {"url": url, "detail": "high"}} for url in doc.data_urls()]
+    text = await ai.stream(m, [{"role": "user", "content": content}], header=header,
+                           message=placeholder, reply_markup=kb)
+    for key in (tg_key, hash_key):
+        await ai_cache.put("gpt-4o", VISION_PROMPT, key, text)
     await state.clear()
 
 # =========================================================
@@ -303,20 +556,58 @@ async def cust_init(m: Message, state: FSMContext):
     await state.set_state(CustomsCalc.cargo_name)
     await m.answer("🔍 Введите название товара (например: 'Литиевые аккумуляторы'):")
 
+def get_duty_kb(tariff_list=()):
+    """Кнопки найденных кодов ТН ВЭД (ставка сразу идет в расчет) + стандартные ставки."""
+    rows = [[InlineKeyboardButton(text=f"{t.code} — {t.rate:g}%", callback_data=f"hscode_{t.code}")] for t in tariff_list]
+    rows += [
+        [InlineKeyboardButton(text="5%", callback_data="setduty_5"), InlineKeyboardButton(text="10%", callback_data="setduty_10")],
+        [InlineKeyboardButton(text="15%", callback_data="setduty_15"), InlineKeyboardButton(text="Свой %", callback_data="setduty_manual")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 @dp.message(CustomsCalc.cargo_name)
 async def cust_ai_tip(m: Message, state: FSMContext):
     await state.update_data(c_name=m.text)
+    matches = [x for x in tariffs.search(m.text or "", limit=3) if x.score >= 0.3]
+    found = [x.tariff for x in matches]
+
+    footer = "\n\nВыберите или введите ставку пошлины для расчета:"
+
+    if tariffs.confident(m.text or "", TARIFF_CONFIDENCE):
+        # Однозначное совпадение в локальном справочнике — GPT не нужен
+        lines = "\n".join(f"• <code>{t.code}</code> — {t.description}: <b>{t.rate:g}%</b>" for t in found)
+        await m.answer(f"📚 <b>Справочник ТН ВЭД:</b>\n{lines}{footer}", reply_markup=get_duty_kb(found))
+        await state.set_state(CustomsCalc.select_duty)
+        return
+
+    def duty_kb_with_ai(answer: str):
+        # Код из ответа AI сверяем со справочником — его ставку можно выбрать одной кнопкой
+        ai_tariff = tariffs.find_in_text(answer)
+        return get_duty_kb(([ai_tariff] if ai_tariff and ai_tariff not in found else []) + found)
+
     # Быстрая подсказка от AI по коду ТН ВЭД
-    res = await client_ai.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "system", "content": "Назови только вероятный код ТН ВЭД и ставку пошлины %."}, {"role": "user", "content": m.text}]
-    )
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="5%", callback_data="setduty_5"), InlineKeyboardButton(text="10%", callback_data="setduty_10")],
-        [InlineKeyboardButton(text="15%", callback_data="setduty_15"), InlineKeyboardButton(text="Свой %", callback_data="setduty_manual")]
-    ])
-    await m.answer(f"💡 <b>Справка AI:</b> {res.choices[0].message.content}\n\nВыберите или введите ставку пошлины для расчета:", reply_markup=kb)
-    await state.set_state(CustomsCalc.select_duty)
+    text = ""
+    try:
+        text = await ai.answer(m, CUSTOMS_PROMPT, m.text, header="💡 <b>Справка AI:</b> ", footer=footer,
+                               reply_markup=duty_kb_with_ai)
+    finally:
+        if not text:
+            # AI не ответил (лимит, сбой) — стрим оставил только сообщение об ошибке, без ставок;
+            # калькулятор продолжается без подсказки
+            await m.answer(footer.strip(), reply_markup=get_duty_kb(found))
+        await state.set_state(CustomsCalc.select_duty)
+
+@dp.callback_query(F.data.startswith("hscode_"), CustomsCalc.select_duty)
+async def cust_set_hs_code(cb: CallbackQuery, state: FSMContext):
+    """Выбор кода из справочника: ставка пошлины берется из него"""
+    tariff = tariffs.get(cb.data.split("_", 1)[1])
+    if not tariff:
+        await cb.answer("Код не найден в справочнике", show_alert=True)
+        return
+    await state.update_data(duty=tariff.rate, hs_code=tariff.code)
+    await cb.message.answer(f"🔢 Код {tariff.code}, пошлина {tariff.rate:g}%.\n💰 Введите инвойсную стоимость товара ($):")
+    await state.set_state(CustomsCalc.cargo_price)
+    await cb.answer()
 
 @dp.callback_query(F.data.startswith("setduty_"), CustomsCalc.select_duty)
 async def cust_set_duty_choice(cb: CallbackQuery, state: FSMContext):
@@ -354,10 +645,12 @@ async def cust_final_calc(m: Message, state: FSMContext):
         duty_v = price * (duty_p / 100)
         vat_v = (price + duty_v) * 0.20 # Стандарт НДС 20%
         total_taxes = duty_v + vat_v
+        hs_line = f"🔢 Код ТН ВЭД: {data['hs_code']}\n" if data.get('hs_code') else ""
         
         res = (f"📊 <b>ПРЕДВАРИТЕЛЬНЫЙ РАСЧЕТ:</b>\n"
                f"━━━━━━━━━━━━━━━━━━\n"
                f"📦 Товар: {data.get('c_name', 'Не указан')}\n"
+               f"{hs_line}"
                f"💵 Стоимость: ${price:,.2f}\n"
                f"⚖️ Пошлина ({duty_p}%): ${duty_v:,.2f}\n"
                f"🏦 НДС (20%): ${vat_v:,.2f}\n"
@@ -382,46 +675,39 @@ async def handle_manual_geo(m: Message):
     map_url = f"https://www.google.com/maps?q={geo}"
     now = datetime.now().strftime("%d.%m.%Y %H:%M")
     
-    conn = sqlite3.connect('logistics.db')
-    # Добавляем IFNULL, чтобы код не падал, если данных нет
-    u = conn.execute("SELECT username, IFNULL(car_number, '-'), IFNULL(route, '-') FROM users WHERE user_id=?", (m.from_user.id,)).fetchone()
-    conn.execute("UPDATE users SET last_geo=?, last_seen=? WHERE user_id=?", (geo, now, m.from_user.id))
-    conn.commit()
-    conn.close()
-
-    row = [u[0] or m.from_user.full_name, u[1], u[2], now, geo, map_url, "🚀 Начал рейс"]
-    # Пишем в отдельный лист Google
-    await save_to_google_sheets(row, "мониторинг водителей")
+    u = await users.get_profile(m.from_user.id)
+    geo_buffer.push(m.from_user.id, geo, int(time.time()))
+    tracks.add(m.from_user.id, lat, lon)
+    fleet.update(m.from_user.id, lat, lon)
+
+    row = [(u and u.username) or m.from_user.full_name, (u and u.car_number) or "-", (u and u.route) or "-", now, geo, map_url, "🚀 Начал рейс"]
+    # Пишем в отдельный лист Google через outbox (ответ водителю не ждет Sheets)
+    await outbox.enqueue(row, "мониторинг водителей", key=f"geo:{m.chat.id}:{m.message_id}")
     await m.answer("✅ <b>Рейс запущен!</b>\nВаш GPS-сигнал транслируется в таблицу.")
 
 @dp.edited_message(F.location)
 async def handle_live_geo(m: Message):
     user_id = m.from_user.id
     geo = f"{m.location.latitude},{m.location.longitude}"
-    now = datetime.now()
-    
-    conn = sqlite3.connect('logistics.db')
-    u = conn.execute("SELECT username, car_number, route, last_google_update FROM users WHERE user_id=?", (user_id,)).fetchone()
-    
-    # Ограничение 3 часа для записи в Google Sheets (чтобы не спамить API)
-    should_update_gs = True
-    if u and u[3]:
+    now = datetime.now().strftime("%d.%m.%Y %H:%M")
+
+    # Позиция уходит в буфер: в БД попадет пакетом при ближайшем flush
+    geo_buffer.push(user_id, geo, int(time.time()))
+    tracks.add(user_id, m.location.latitude, m.location.longitude)
+    fleet.update(user_id, m.location.latitude, m.location.longitude)
+
+    # Ограничение 3 часа для записи в Google Sheets (чтобы не спамить API) — по монотонным часам в памяти
+    if geo_buffer.should_log_to_sheets(user_id):
         try:
-            last_dt = datetime.strptime(u[3], "%d.%m.%Y %H:%M")
-            if (now - last_dt).total_seconds() < 10800:
-                should_update_gs = False
-        except:
-            should_update_gs = True
-
-    if should_update_gs:
-        map_url = f"https://www.google.com/maps?q={geo}"
-        row = [u[0] or "Водитель", u[1] or "-", u[2] or "-", now.strftime("%d.%m.%Y %H:%M"), geo, map_url, "🚚 В пути"]
-        await save_to_google_sheets(row, "мониторинг водителей")
-        conn.execute("UPDATE users SET last_google_update=? WHERE user_id=?", (now.strftime("%d.%m.%Y %H:%M"), user_id))
-    
-    conn.execute("UPDATE users SET last_geo=?, last_seen=? WHERE user_id=?", (geo, now.strftime("%d.%m.%Y %H:%M"), user_id))
-    conn.commit()
-    conn.close()
+            u = await users.get_profile(user_id)
+            map_url = f"https://www.google.com/maps?q={geo}"
+            row = [(u and u.username) or "Водитель", (u and u.car_number) or "-", (u and u.route) or "-", now, geo, map_url, "🚚 В пути"]
+            await outbox.enqueue(row, "мониторинг водителей", key=f"geo:{m.chat.id}:{m.message_id}:{m.edit_date}")
+        except BaseException:
+            # Строка не легла в очередь — снимаем отметку, иначе водитель пропадет из Sheets на 3 часа
+            geo_buffer.sheets_failed(user_id)
+            raise
+        await users.set_google_update(user_id, int(time.time()))
 
 # =========================================================
 # 10. АДМИНКА, РАССЫЛКА И AI-КОНСУЛЬТАНТ
@@ -430,49 +716,173 @@ async def handle_live_geo(m: Message):
 async def cb_stats(cb: CallbackQuery):
     if cb.from_user.id not in ADMIN_IDS: return
     
-    conn = sqlite3.connect('logistics.db')
-    # Более мощный запрос: общее кол-во и список последних 5 имен
-    total = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    recent = conn.execute("SELECT username FROM users ORDER BY last_seen DESC LIMIT 5").fetchall()
-    conn.close()
+    # Счетчики ведут триггеры, активность — корзины в памяти, заказы — строки по дням:
+    # ни одного полного прохода по users
+    counters = await users.counters()
+    orders = await order_stats.last_days(7)
+    recent = await users.recent_usernames(5)
     
-    names = ", ".join([f"@{r[0]}" for r in recent if r[0]])
+    names = ", ".join([f"@{name}" for name in recent if name])
     res = (f"📊 <b>СТАТИСТИКА БАЗЫ</b>\n"
            f"━━━━━━━━━━━━━━━━━━\n"
-           f"👥 Всего пользователей: <b>{total}</b>\n"
+           f"👥 Всего пользователей: <b>{counters.get('users', 0)}</b>\n"
+           f"🟢 Активны за 24ч: <b>{activity.active(24)}</b> · за 7д: <b>{activity.active(168)}</b>\n"
+           f"🚚 Водителей: <b>{counters.get('role:' + ROLE_DRIVER, 0)}</b> · активны за 24ч: <b>{activity.active(24, drivers=True)}</b>\n"
+           f"📦 Заказов сегодня: <b>{orders.get(date.today().isoformat(), 0)}</b> · за 7д: <b>{sum(orders.values())}</b>\n"
+           f"🚫 Заблокировали бота: {counters.get('blocked', 0)}\n"
            f"🕒 Последние в сети: <i>{names}</i>")
     
     await cb.message.answer(res)
     await cb.answer()
 
+@dp.callback_query(F.data == "metrics_summary")
+async def cb_metrics(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS: return
+    ms = lambda s: f"{s * 1000:.0f}"
+    def block(title, name, label):
+        rows = metrics.summary(name, limit=8)
+        lines = [f"<code>{r[0].get(label, '—')[:22]:<22} {r[1]:>6} {ms(r[2]):>5} {ms(r[3]):>5} {ms(r[4]):>5}</code>" for r in rows]
+        return f"<b>{title}</b>\n" + ("\n".join(lines) or "нет данных")
+    tokens = {kind: metrics.REGISTRY.counter("openai_tokens", kind=kind) for kind in ("prompt", "completion")}
+    await cb.message.answer(
+        "⏱ <b>МЕТРИКИ</b> (мс: p50 / p95 / p99)\n"
+        "━━━━━━━━━━━━━━━━━━\n"
+        + block("Хендлеры", "handler_seconds", "handler") + "\n\n"
+        + block("OpenAI", "openai_seconds", "endpoint") + "\n\n"
+        + block("SQLite", "db_seconds", "op") + "\n\n"
+        + block("Google Sheets", "sheets_seconds", "op") + "\n\n"
+        + f"🔤 Токены OpenAI: {tokens['prompt']:.0f} вход / {tokens['completion']:.0f} выход"
+    )
+    await cb.answer()
+
+@dp.callback_query(F.data == "outbox_stats")
+async def cb_outbox(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS: return
+    await cb.message.answer(await outbox_report())
+    await cb.answer()
+
+@dp.callback_query(F.data == "broadcast_new")
+async def cb_broadcast_new(cb: CallbackQuery, state: FSMContext):
+    if cb.from_user.id not in ADMIN_IDS: return
+    if broadcaster.active:
+        await cb.answer("Рассылка уже идет", show_alert=True)
+        return
+    await state.set_state(Broadcast.waiting_for_text)
+    await cb.message.answer("📣 Пришлите текст рассылки (форматирование сохранится):")
+    await cb.answer()
+
+@dp.message(Broadcast.waiting_for_text, F.text)
+async def broadcast_text(m: Message, state: FSMContext):
+    if m.from_user.id not in ADMIN_IDS: return
+    await state.update_data(broadcast=m.html_text)
+    total = await users.count_recipients()
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"✅ Отправить ({total})", callback_data="broadcast_go"),
+        InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel"),
+    ]])
+    await m.answer(f"👆 Так увидят сообщение получатели. Отправить <b>{total}</b> пользователям?", reply_markup=kb)
+
+@dp.callback_query(F.data.in_({"broadcast_go", "broadcast_cancel"}), Broadcast.waiting_for_text)
+async def cb_broadcast_confirm(cb: CallbackQuery, state: FSMContext):
+    if cb.from_user.id not in ADMIN_IDS: return
+    text = (await state.get_data()).get("broadcast")
+    await state.clear()
+    await cb.message.edit_reply_markup(reply_markup=None)
+    if cb.data == "broadcast_cancel" or not text:
+        await cb.answer("Рассылка отменена")
+        return
+    bid = await broadcaster.start(cb.from_user.id, text)
+    await cb.answer(f"Рассылка #{bid} запущена" if bid else "Рассылка уже идет", show_alert=not bid)
+
+@dp.callback_query(F.data.startswith("bc_stop:") | F.data.startswith("bc_resume:"))
+async def cb_broadcast_control(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS: return
+    action, bid = cb.data.split(":")
+    if action == "bc_stop":
+        ok = broadcaster.stop(int(bid))
+        await cb.answer("Остановится после текущей страницы" if ok else "Рассылка не активна")
+    else:
+        ok = await broadcaster.resume(int(bid))
+        await cb.answer("Продолжаем" if ok else "Уже идет другая рассылка или эта завершена", show_alert=not ok)
+        if ok: await cb.message.edit_reply_markup(reply_markup=None)
+
 @dp.message(F.text & ~F.state())
 async def ai_consultant(m: Message):
     # Если это кнопка меню — не отвечаем как AI
     if m.text in ["🚛 Оформить перевозку", "🛡 Таможня", "📄 Анализ документов", "👨‍💼 Менеджер"]: 
         return
         
-    await bot.send_chat_action(m.chat.id, ChatAction.TYPING)
-    # Используем твой фирменный промпт
-    res = await client_ai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "Ты эксперт Logistics Manager. Доставка из Китая в Европу 18 дней, низкие цены. Предлагай нажать 'Оформить перевозку'."}, 
-            {"role": "user", "content": m.text}
-        ]
-    )
-    await m.answer(f"🏢 <b>Logistics Manager:</b>\n\n{res.choices[0].message.content}")
+    # Используем твой фирменный промпт; первый вопрос может прийти из кэша, уточнения — в контексте диалога
+    answer = await ai.answer(m, CONSULTANT_PROMPT, m.text, header="🏢 <b>Logistics Manager:</b>\n\n",
+                             history=dialogs.history(m.from_user.id))
+    if answer: dialogs.add(m.from_user.id, m.text, answer)
 
 # =========================================================
 # ЗАПУСК БОТА
 # =========================================================
-async def main():
+async def on_startup() -> list:
     init_db()
+    await users.load_roles()
+    activity.load(await users.seen_since(int(time.time()) - 7 * 86400),
+                  drivers=users.with_role(ROLE_DRIVER))
+    await geo_buffer.load_throttle()
+    await load_fleet_index()
+    await ai_cache.load()
     print("✅ База данных готова")
-    print("🚀 Бот Logistics Manager запущен и ожидает сообщений...")
-    
-    # Сброс вебхуков и запуск пуллинга
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # Фоновые задачи: очередь Sheets, буфер GPS, треки, чистка кэша AI и брошенных диалогов
+    background = [asyncio.create_task(job.run()) for job in (outbox, geo_buffer, tracks, ai_cache, fsm_storage)]
+    # Рассылка, прерванная перезапуском, продолжается с последней сохраненной страницы
+    await broadcaster.resume_unfinished()
+    return background
+
+async def on_shutdown(background: list, metrics_runner=None):
+    """Вызывается, когда новые апдейты уже не принимаются: дописываем все отложенное и закрываемся."""
+    for task in background: task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()      # освобождает METRICS_PORT
+    await broadcaster.close()
+    await dialogs.close()
+    await geo_buffer.flush()
+    await tracks.flush(force=True)
+    await gs_writer.close()
+    await fsm_storage.close()
+    await db.close()
+    docs.close()
+    await bot.session.close()
+
+async def run_webhook():
+    server = WebhookServer(
+        dp, bot, url=os.environ["WEBHOOK_URL"], path=os.getenv("WEBHOOK_PATH", "/webhook"),
+        host=os.getenv("WEBAPP_HOST", "0.0.0.0"), port=int(os.getenv("WEBAPP_PORT", "8080")),
+        secret=os.getenv("WEBHOOK_SECRET") or None, max_tasks=MAX_UPDATE_TASKS,
+    )
+    stop = asyncio.Event()
+    if platform.system() != 'Windows':
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await server.start()
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+
+async def main():
+    background = await on_startup()
+    print(f"🚀 Бот Logistics Manager запущен ({RUN_MODE}) и ожидает сообщений...")
+    metrics_runner = None
+    try:
+        if os.getenv("METRICS_PORT"):
+            # /metrics — на своем порту в обоих режимах, чтобы не светить его на публичном webhook
+            metrics_runner = await metrics.serve(os.getenv("METRICS_HOST", "0.0.0.0"), int(os.environ["METRICS_PORT"]))
+        if RUN_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Сброс вебхуков и запуск пуллинга
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, tasks_concurrency_limit=MAX_UPDATE_TASKS, close_bot_session=False)
+    finally:
+        await on_shutdown(background, metrics_runner)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики процесса: гистограммы задержек и счетчики в памяти.
+
+Гистограмма — фиксированные корзины (как в Prometheus), observe() — это
+bisect по ~20 границам и два инкремента, так что на горячем пути стоит
+около микросекунды. Перцентили p50/p95/p99 оцениваются интерполяцией
+внутри корзины. Наблюдения приходят и из потоков (SQLite, gspread),
+поэтому обновление под коротким lock.
+
+Все метрики — в модульном REGISTRY; наружу отдаются текстом в формате
+Prometheus (/metrics) и сводкой для админки.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+# 0.5 мс ... 60 с: от SQLite-чтения из кэша до долгого ответа vision
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "_lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)      # последняя — +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(BUCKETS, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            if seen + c >= rank and c:
+                lo = BUCKETS[i - 1] if i else 0.0
+                hi = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return BUCKETS[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}       # (name, labels) -> Histogram
+        self._counters = {}         # (name, labels) -> float
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def histogram(self, name: str, labels: tuple = ()) -> Histogram:
+        key = (name, labels)
+        h = self._histograms.get(key)
+        if h is None:
+            with self._lock:
+                h = self._histograms.setdefault(key, Histogram())
+        return h
+
+    def observe(self, name: str, labels: tuple, value: float):
+        self.histogram(name, labels).observe(value)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1.0):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def counter(self, name: str, **labels) -> float:
+        """Сумма счетчика по всем сериям, у которых совпадают заданные метки."""
+        want = set(labels.items())
+        return sum(v for (n, lb), v in list(self._counters.items()) if n == name and want <= set(lb))
+
+    def histograms(self, name: str):
+        """[(labels, Histogram), ...] одной метрики."""
+        return [(labels, h) for (n, labels), h in list(self._histograms.items()) if n == name]
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus."""
+        out, seen = [], set()
+
+        def header(name, kind):
+            if name in seen: return
+            seen.add(name)
+            if name in self._help: out.append(f"# HELP {name} {self._help[name]}")
+            out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), h in sorted(self._histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, c in zip(BUCKETS + ("+Inf",), h.counts):
+                cumulative += c
+                out.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            out.append(f"{name}_sum{_labels(labels)} {h.sum:.6f}")
+            out.append(f"{name}_count{_labels(labels)} {h.count}")
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, "counter")
+            out.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(out) + "\n"
+
+
+def _escape(value) -> str:
+    """Значение метки по формату Prometheus: обратный слэш, кавычка и перевод строки экранируются."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels) -> str:
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+
+REGISTRY.describe("handler_seconds", "Время обработки апдейта хендлером")
+REGISTRY.describe("db_seconds", "Время операций SQLite (query — чтение/транзакция, commit — групповой коммит)")
+REGISTRY.describe("db_commit_statements", "Запросов записи, ушедших в групповые коммиты")
+REGISTRY.describe("sheets_seconds", "Время вызовов Google Sheets")
+REGISTRY.describe("openai_seconds", "Время запросов к OpenAI (стрим — до последнего токена)")
+REGISTRY.describe("openai_ttft_seconds", "Время до первого токена стрима OpenAI")
+REGISTRY.describe("openai_queue_seconds", "Ожидание слота в планировщике OpenAI")
+REGISTRY.describe("openai_tokens", "Токены OpenAI по модели и виду")
+REGISTRY.describe("loop_lag_seconds", "Задержка event loop: насколько позже срока просыпается тикер webhook-сервера")
+
+
+@contextmanager
+def timer(name: str, labels: tuple = ()):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, labels, time.perf_counter() - start)
+
+
+def count_usage(model: str, usage):
+    """Токены из usage ответа OpenAI (обычного или финального чанка стрима)."""
+    if usage is None: return
+    inc("openai_tokens", (("model", model), ("kind", "prompt")), getattr(usage, "prompt_tokens", 0) or 0)
+    inc("openai_tokens", (("model", model), ("kind", "completion")), getattr(usage, "completion_tokens", 0) or 0)
+
+
+# Ключ в data, через который внутренние middleware сообщают исход, если сами погасили ошибку
+STATUS_KEY = "metrics_status"
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время каждого хендлера; метка — имя функции хендлера и исход (ok/error или data[STATUS_KEY])."""
+
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        status = None
+        try:
+            return await handler(event, data)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            status = status or data.get(STATUS_KEY, "ok")
+            obj = data.get("handler")
+            name = getattr(getattr(obj, "callback", None), "__name__", "unknown")
+            REGISTRY.observe("handler_seconds", (("handler", name), ("status", status)),
+                             time.perf_counter() - start)
+
+
+def summary(name: str, limit: int = 10, key=lambda h: h.quantile(0.95)):
+    """[(labels, count, p50, p95, p99), ...] — самые медленные по p95."""
+    items = sorted(REGISTRY.histograms(name), key=lambda kv: key(kv[1]), reverse=True)[:limit]
+    return [(dict(labels), h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99)) for labels, h in items]
+
+
+async def metrics_handler(request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(host: str, port: int):
+    """Отдельный HTTP-сервер с /metrics (в обоих режимах — не на публичном порту webhook)."""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
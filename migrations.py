@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Миграции схемы logistics.db.
+
+Модули создают свои таблицы в init_schema (CREATE IF NOT EXISTS — исходный
+вид), а все последующие изменения идут отсюда по порядку. Номер последней
+примененной миграции хранится в PRAGMA user_version; каждая миграция
+выполняется в своей транзакции вместе с повышением версии, поэтому
+прерванный старт просто повторит ее. Миграции только добавляются в конец
+списка, уже выпущенные не меняются.
+"""
+import logging
+import sqlite3
+from datetime import datetime
+
+from repository import ROLE_CLIENT
+
+LEGACY_TS = "%d.%m.%Y %H:%M"
+
+
+def _add_column(conn, table: str, column: str, decl: str):
+    if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _legacy_epoch(value):
+    """'дд.мм.гггг чч:мм' (локальное время) -> unix-время; мусор и NULL -> None."""
+    try:
+        return int(datetime.strptime(value, LEGACY_TS).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backfill_epoch(conn, table: str, text_col: str, epoch_col: str):
+    rows = conn.execute(f"SELECT rowid, {text_col} FROM {table} WHERE {text_col} IS NOT NULL").fetchall()
+    conn.executemany(f"UPDATE {table} SET {epoch_col}=? WHERE rowid=?",
+                     [(_legacy_epoch(ts), rowid) for rowid, ts in rows])
+    return len(rows)
+
+
+# --- Миграции ---
+def _m1_blocked_at(conn):
+    """users.blocked_at для рассылок (в базах, созданных до них)."""
+    _add_column(conn, "users", "blocked_at", "INTEGER")
+
+
+def _m2_epoch_timestamps(conn):
+    """Время визита и отметки Sheets — unix-время с индексом вместо текста 'дд.мм.гггг чч:мм'.
+
+    Текст сортировался по дню месяца и без индекса; старые колонки остаются, но больше не пишутся.
+    """
+    _add_column(conn, "users", "last_seen_at", "INTEGER")
+    _add_column(conn, "users", "last_google_update_at", "INTEGER")
+    n = _backfill_epoch(conn, "users", "last_seen", "last_seen_at")
+    _backfill_epoch(conn, "users", "last_google_update", "last_google_update_at")
+    # blocked_at писался тем же текстом; для рассылок важен только IS NULL
+    conn.executemany("UPDATE users SET blocked_at=? WHERE rowid=?",
+                     [(_legacy_epoch(ts) or 0, rowid) for rowid, ts in
+                      conn.execute("SELECT rowid, blocked_at FROM users WHERE typeof(blocked_at)='text'")])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen_at ON users(last_seen_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
+    logging.info(f"Migration: {n} users moved to epoch timestamps")
+
+
+# Счетчики пользователей ведут триггеры — любая запись в users (и из старого кода) их обновляет
+_COUNTER_TRIGGERS = f'''
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0);
+CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN
+    INSERT INTO counters (name, value) VALUES ('users', 1)
+        ON CONFLICT(name) DO UPDATE SET value=value+1;
+    INSERT INTO counters (name, value) VALUES ('role:' || COALESCE(new.role, '{ROLE_CLIENT}'), 1)
+        ON CONFLICT(name) DO UPDATE SET value=value+1;
+    INSERT INTO counters (name, value) VALUES ('blocked', new.blocked_at IS NOT NULL)
+        ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users BEGIN
+    UPDATE counters SET value=value-1 WHERE name='users';
+    UPDATE counters SET value=value-1 WHERE name='role:' || COALESCE(old.role, '{ROLE_CLIENT}');
+    UPDATE counters SET value=value-1 WHERE name='blocked' AND old.blocked_at IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_role AFTER UPDATE OF role ON users
+WHEN COALESCE(old.role, '{ROLE_CLIENT}') != COALESCE(new.role, '{ROLE_CLIENT}') BEGIN
+    UPDATE counters SET value=value-1 WHERE name='role:' || COALESCE(old.role, '{ROLE_CLIENT}');
+    INSERT INTO counters (name, value) VALUES ('role:' || COALESCE(new.role, '{ROLE_CLIENT}'), 1)
+        ON CONFLICT(name) DO UPDATE SET value=value+1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_blocked AFTER UPDATE OF blocked_at ON users
+WHEN (old.blocked_at IS NULL) != (new.blocked_at IS NULL) BEGIN
+    INSERT INTO counters (name, value) VALUES ('blocked', CASE WHEN new.blocked_at IS NULL THEN -1 ELSE 1 END)
+        ON CONFLICT(name) DO UPDATE SET value=value+excluded.value;
+END;'''
+
+
+def _m3_counters(conn):
+    """Таблица counters (всего, по ролям, заблокировавшие) и заказы по дням — админка без COUNT(*)."""
+    for stmt in _split_script(_COUNTER_TRIGGERS):
+        conn.execute(stmt)
+    conn.execute("DELETE FROM counters")
+    conn.execute("INSERT INTO counters (name, value) SELECT 'users', COUNT(*) FROM users")
+    conn.execute("INSERT INTO counters (name, value) SELECT 'blocked', COUNT(*) FROM users WHERE blocked_at IS NOT NULL")
+    conn.execute(f"INSERT INTO counters (name, value) SELECT 'role:' || COALESCE(role, '{ROLE_CLIENT}'), COUNT(*) "
+                 f"FROM users GROUP BY COALESCE(role, '{ROLE_CLIENT}')")
+    conn.execute("CREATE TABLE IF NOT EXISTS daily_orders (day TEXT PRIMARY KEY, orders INTEGER NOT NULL DEFAULT 0)")
+    # История — из очереди Sheets (отправленные строки там хранятся неделю); раньше заказы в БД не считались
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='gs_outbox'").fetchone():
+        conn.execute("INSERT OR IGNORE INTO daily_orders (day, orders) "
+                     "SELECT date(created_at, 'unixepoch', 'localtime'), COUNT(*) FROM gs_outbox "
+                     "WHERE sheet_name IS NULL AND row_json LIKE '[\"ЗАКАЗ\"%' GROUP BY 1")
+
+
+def _m4_outbox_dead(conn):
+    """gs_outbox.dead_at — строки, которые Sheets стабильно отклоняет 4xx, больше не ретраятся."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='gs_outbox'").fetchone():
+        _add_column(conn, "gs_outbox", "dead_at", "REAL")
+
+
+def _split_script(script: str):
+    """Выражения скрипта по одному (executescript сам коммитит и вышел бы из транзакции миграции)."""
+    stmts, buf = [], ""
+    for line in script.strip().splitlines(keepends=True):
+        buf += line
+        if buf.strip() and sqlite3.complete_statement(buf):
+            stmts.append(buf.strip())
+            buf = ""
+    return stmts
+
+
+MIGRATIONS = [
+    _m1_blocked_at,
+    _m2_epoch_timestamps,
+    _m3_counters,
+    _m4_outbox_dead,
+]
+
+
+def apply(db, migrations=MIGRATIONS) -> int:
+    """Догоняет схему до последней миграции (синхронно, при старте после init_schema модулей)."""
+    current = db.user_version
+    for version, fn in enumerate(migrations, start=1):
+        if version <= current: continue
+        db.migrate(version, fn)
+        logging.info(f"Migration {version} ({fn.__name__}) applied")
+    return len(migrations)
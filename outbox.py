@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Надежная очередь (outbox) строк для Google Sheets в logistics.db.
+
+Хендлер фиксирует строку локально (один INSERT в групповом коммите db.Database), а фоновый
+дренажер отправляет накопившееся пакетами через SheetsWriter. Ошибки
+ретраятся с экспоненциальной задержкой, 429 от Sheets ставит на паузу
+всю очередь, а ключ идемпотентности не дает задвоить строку ни при
+повторной доставке апдейта, ни при повторной отправке после таймаута.
+Сверка хвоста листа нужна только там, где запрос мог дойти (таймаут,
+обрыв соединения, 5xx). Строки, которые Sheets раз за разом отклоняет
+ошибкой 4xx (кроме 429), после dead_after попыток откладываются в
+«мертвые» (dead_at) — их видно в /outbox, дренажер их больше не берет.
+Пока SheetsWriter не настроен, очередь просто копится, попытки не тратятся.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from collections import Counter
+
+import gspread
+import requests
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS gs_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key TEXT NOT NULL UNIQUE,
+    sheet_name TEXT,
+    row_json TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try_at REAL NOT NULL DEFAULT 0,
+    uncertain INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    sent_at REAL);
+CREATE INDEX IF NOT EXISTS idx_gs_outbox_pending ON gs_outbox(next_try_at) WHERE sent_at IS NULL;'''
+# dead_at добавляет migrations.py (миграция 4)
+
+# Ответа могло не быть, а запрос — выполниться: перед повтором сверяем хвост листа
+_TRANSIENT = (asyncio.TimeoutError, TimeoutError, ConnectionError,
+              requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+
+
+def _status_code(e):
+    if isinstance(e, gspread.exceptions.APIError):
+        return getattr(e.response, "status_code", None)
+    return None
+
+
+def _uncertain(e, status) -> bool:
+    return isinstance(e, _TRANSIENT) or (status is not None and status >= 500)
+
+
+def _row_key(row):
+    cells = ["" if c is None else str(c) for c in row]
+    while cells and cells[-1] == "":
+        cells.pop()
+    return tuple(cells)
+
+
+class SheetsOutbox:
+    def __init__(self, db, writer, batch_size=200, min_interval=1.0,
+                 base_backoff=2.0, max_backoff=900.0, keep_sent_days=7, tail_check=200, dead_after=5):
+        self._db = db
+        self._writer = writer
+        self._batch_size = batch_size
+        self._min_interval = min_interval    # Sheets: ~60 запросов записи в минуту на пользователя
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._keep_sent = keep_sent_days * 86400
+        self._tail_check = tail_check        # сколько последних строк листа сверять после таймаута
+        self._dead_after = dead_after        # попыток с 4xx, после которых строка считается мертвой
+        self._wake = asyncio.Event()
+        self._paused_until = 0.0             # пауза всей очереди после 429
+        self._quota_strikes = 0
+
+    def init_schema(self):
+        self._db.execute_script(SCHEMA)
+
+    # --- Запись из хендлеров ---
+    async def enqueue(self, row: list, sheet_name=None, key=None) -> bool:
+        """Фиксирует строку локально. False — строка с таким ключом уже была поставлена."""
+        added = await self._db.execute(
+            "INSERT OR IGNORE INTO gs_outbox (idem_key, sheet_name, row_json, created_at) VALUES (?, ?, ?, ?)",
+            (key or uuid.uuid4().hex, sheet_name, json.dumps(row, ensure_ascii=False), time.time())
+        )
+        self._wake.set()
+        return added == 1
+
+    async def stats(self) -> dict:
+        depth, oldest, max_attempts = await self._db.fetchone(
+            "SELECT COUNT(*), MIN(created_at), MAX(attempts) FROM gs_outbox WHERE sent_at IS NULL AND dead_at IS NULL"
+        )
+        last_error = await self._db.fetchone(
+            "SELECT last_error FROM gs_outbox WHERE sent_at IS NULL AND dead_at IS NULL AND last_error IS NOT NULL "
+            "ORDER BY id DESC LIMIT 1"
+        )
+        dead, dead_error = await self._db.fetchone(
+            "SELECT COUNT(*), (SELECT last_error FROM gs_outbox WHERE dead_at IS NOT NULL ORDER BY dead_at DESC LIMIT 1) "
+            "FROM gs_outbox WHERE dead_at IS NOT NULL"
+        )
+        now = time.time()
+        return {
+            "depth": depth,
+            "oldest_age": now - oldest if oldest else 0.0,
+            "max_attempts": max_attempts or 0,
+            "last_error": last_error[0] if last_error else None,
+            "paused_for": max(0.0, self._paused_until - now),
+            "configured": self._writer.configured,
+            "dead": dead,
+            "dead_error": dead_error,
+        }
+
+    # --- Фоновый дренажер ---
+    async def run(self):
+        last_purge = 0.0
+        while True:
+            self._wake.clear()
+            try:
+                if time.time() - last_purge > 3600:
+                    await self._purge_sent()
+                    last_purge = time.time()
+                sent_any = await self._drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Outbox error: {e}")
+                sent_any = False
+            if sent_any:
+                await asyncio.sleep(self._min_interval)
+            else:
+                await self._wait(await self._idle_timeout())
+
+    async def _wait(self, timeout):
+        """Спит до нового enqueue, ближайшего ретрая или конца паузы по квоте."""
+        timeout = max(timeout, self._paused_until - time.time(), self._min_interval)
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _idle_timeout(self):
+        row = await self._db.fetchone("SELECT MIN(next_try_at) FROM gs_outbox WHERE sent_at IS NULL AND dead_at IS NULL")
+        if not row or row[0] is None: return 60.0
+        return min(60.0, max(0.0, row[0] - time.time()))
+
+    async def _drain_once(self) -> bool:
+        if time.time() < self._paused_until: return False
+        # Без SHEET_ID / ключа писать некуда: строки ждут настройки, попытки и сверки не тратим
+        if not self._writer.configured: return False
+        rows = await self._db.fetchall(
+            "SELECT id, sheet_name, row_json, uncertain, attempts FROM gs_outbox "
+            "WHERE sent_at IS NULL AND dead_at IS NULL AND next_try_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), self._batch_size)
+        )
+        if not rows: return False
+
+        groups = {}
+        for rid, sheet_name, row_json, uncertain, attempts in rows:
+            groups.setdefault(sheet_name, []).append((rid, json.loads(row_json), uncertain, attempts))
+
+        sent_any = False
+        for sheet_name, items in groups.items():
+            if time.time() < self._paused_until: break
+            sent_any = await self._send_group(sheet_name, items) or sent_any
+        return sent_any
+
+    async def _send_group(self, sheet_name, items) -> bool:
+        if any(it[2] for it in items):
+            # Прошлая попытка оборвалась по таймауту/5xx — часть строк могла дойти
+            try:
+                present = await self._already_written(sheet_name, [it[1] for it in items])
+            except Exception as e:
+                await self._fail(items, e)
+                return False
+            await self._mark_sent([it[0] for it, dup in zip(items, present) if dup])
+            items = [it for it, dup in zip(items, present) if not dup]
+            if not items: return True
+
+        try:
+            await self._writer.write_rows([it[1] for it in items], sheet_name)
+        except Exception as e:
+            await self._fail(items, e)
+            return False
+        await self._mark_sent([it[0] for it in items])
+        self._quota_strikes = 0
+        return True
+
+    async def _already_written(self, sheet_name, rows) -> list:
+        """Для каждой строки — есть ли она уже в хвосте листа (с учетом повторов)."""
+        tail = await self._writer.read_tail(sheet_name, self._tail_check)
+        have = Counter(_row_key(r) for r in tail)
+        result = []
+        for row in rows:
+            key = _row_key(row)
+            found = have[key] > 0
+            if found: have[key] -= 1
+            result.append(found)
+        return result
+
+    async def _mark_sent(self, ids):
+        if not ids: return
+        now = time.time()
+        await self._db.executemany("UPDATE gs_outbox SET sent_at=?, last_error=NULL WHERE id=?", [(now, i) for i in ids])
+
+    async def _fail(self, items, e):
+        status = _status_code(e)
+        now = time.time()
+        if status == 429:
+            # Квота Sheets: останавливаем всю очередь, пауза растет с каждым 429 подряд
+            self._quota_strikes += 1
+            pause = min(self._max_backoff, 60.0 * 2 ** (self._quota_strikes - 1))
+            self._paused_until = now + pause
+            logging.warning(f"Outbox: квота Google Sheets, пауза {pause:.0f} с")
+        # Таймаут, обрыв соединения или 5xx: запрос мог быть выполнен — перед повтором сверим хвост листа
+        uncertain = 1 if _uncertain(e, status) else 0
+        # 4xx кроме 429 — Sheets отклоняет сам запрос, повтор его не исправит
+        rejected = status is not None and 400 <= status < 500 and status != 429
+        error = f"{type(e).__name__}: {e}"[:300]
+        params = []
+        dead = 0
+        for rid, _, _, attempts in items:
+            attempts += 1
+            delay = min(self._max_backoff, self._base_backoff * 2 ** attempts) * random.uniform(0.5, 1.0)
+            dead_at = now if rejected and attempts >= self._dead_after else None
+            dead += dead_at is not None
+            params.append((attempts, max(now + delay, self._paused_until), uncertain, error, dead_at, rid))
+        await self._db.executemany(
+            "UPDATE gs_outbox SET attempts=?, next_try_at=?, uncertain=MAX(uncertain, ?), last_error=?, dead_at=? "
+            "WHERE id=?", params
+        )
+        logging.error(f"GS Error (outbox, {len(items)} стр.): {e}")
+        if dead:
+            logging.error(f"Outbox: {dead} стр. отложено как мертвые после {self._dead_after} отказов Sheets")
+
+    async def _purge_sent(self):
+        await self._db.execute("DELETE FROM gs_outbox WHERE sent_at IS NOT NULL AND sent_at < ?", (time.time() - self._keep_sent,))
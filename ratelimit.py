@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Ограничители частоты: token bucket на ключ (лимиты пользователей) и общий
+асинхронный лимитер (исходящие сообщения рассылки под лимит Bot API).
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket на ключ: capacity запросов подряд, дальше rate в секунду."""
+
+    def __init__(self, rate: float, capacity: float, max_keys=100000):
+        self._rate = rate
+        self._capacity = capacity
+        self._max_keys = max_keys
+        self._buckets = {}      # key -> (tokens, ts)
+
+    def take(self, key, cost=1.0, now=None) -> float:
+        """0 — можно; иначе через сколько секунд появится нужный токен."""
+        now = time.monotonic() if now is None else now
+        tokens, ts = self._buckets.get(key, (self._capacity, now))
+        tokens = min(self._capacity, tokens + (now - ts) * self._rate)
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / self._rate
+        self._buckets[key] = (tokens - cost, now)
+        if len(self._buckets) > self._max_keys:
+            self._prune(now)
+        return 0.0
+
+    def _prune(self, now):
+        # Полные ведра ничем не отличаются от отсутствующих
+        full = [k for k, (t, ts) in self._buckets.items() if t + (now - ts) * self._rate >= self._capacity]
+        for k in full:
+            del self._buckets[k]
+
+
+class RateLimiter:
+    """Не больше rate событий в секунду на весь процесс; pause() — общая пауза (RetryAfter)."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self._bucket = TokenBucket(rate, burst)
+        self._paused_until = 0.0
+
+    async def wait(self):
+        while True:
+            delay = max(self._paused_until - time.monotonic(), self._bucket.take(None))
+            if delay <= 0: return
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Репозиторий таблицы users поверх db.Database: хендлеры не пишут сырой SQL.
+
+Роли держим в памяти целиком (не-клиентов единицы, грузим при старте), а
+профили — в ограниченном LRU-кэше. Любая запись через репозиторий обновляет
+или сбрасывает кэш, поэтому горячий путь (клавиатуры) не ходит в БД вовсе.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+ROLE_CLIENT = "Клиент"
+ROLE_DRIVER = "Водитель"
+
+# Исходный вид таблицы; новые колонки, индексы и счетчики добавляют migrations.py
+SCHEMA = '''CREATE TABLE IF NOT EXISTS users
+    (user_id INTEGER PRIMARY KEY, username TEXT, role TEXT DEFAULT 'Клиент',
+    status TEXT, last_seen TEXT, last_geo TEXT, car_number TEXT, route TEXT, last_google_update TEXT);'''
+
+# Константные SQL-строки: sqlite3 переиспользует подготовленные выражения
+# Время везде — unix-секунды (колонки *_at); текстовые last_seen/last_google_update остались от старых версий
+_TOUCH = ("INSERT INTO users (user_id, username, last_seen_at) VALUES (?, ?, ?) "
+          "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, last_seen_at=excluded.last_seen_at, blocked_at=NULL")
+_SET_ROLE = "UPDATE users SET role=? WHERE user_id=?"
+_GET_PROFILE = "SELECT user_id, username, role, car_number, route, last_geo, last_google_update_at FROM users WHERE user_id=?"
+_UPDATE_GEO = "UPDATE users SET last_geo=?, last_seen_at=? WHERE user_id=?"
+_SET_GOOGLE_UPDATE = "UPDATE users SET last_google_update_at=? WHERE user_id=?"
+_GOOGLE_UPDATES = "SELECT user_id, last_google_update_at FROM users WHERE last_google_update_at>?"
+_POSITIONS = "SELECT user_id, last_geo, last_seen_at FROM users WHERE last_geo IS NOT NULL"
+_LOAD_ROLES = "SELECT user_id, role FROM users WHERE role IS NOT NULL AND role != ?"
+_COUNTERS = "SELECT name, value FROM counters"
+_RECENT = "SELECT username FROM users ORDER BY last_seen_at DESC LIMIT ?"
+_SEEN_SINCE = "SELECT user_id, last_seen_at FROM users WHERE last_seen_at>=?"
+_RECIPIENTS = "SELECT user_id FROM users WHERE user_id>? AND blocked_at IS NULL ORDER BY user_id LIMIT ?"
+_MARK_BLOCKED = "UPDATE users SET blocked_at=? WHERE user_id=?"
+
+
+class UserProfile(NamedTuple):
+    user_id: int
+    username: Optional[str]
+    role: str
+    car_number: Optional[str]
+    route: Optional[str]
+    last_geo: Optional[str]
+    last_google_update: Optional[int]
+
+
+class UserRepository:
+    def __init__(self, db, cache_size=10000, activity=None):
+        self._db = db
+        self._activity = activity            # stats.ActivityTracker: активные за 24ч/7д без запросов к БД
+        self._cache_size = cache_size
+        self._profiles = OrderedDict()       # user_id -> UserProfile (LRU)
+        self._roles: Dict[int, str] = {}     # только не-клиентские роли; нет в словаре = Клиент
+
+    def init_schema(self):
+        self._db.execute_script(SCHEMA)
+
+    async def load_roles(self):
+        """Загружает все не-клиентские роли в память (при старте)."""
+        rows = await self._db.fetchall(_LOAD_ROLES, (ROLE_CLIENT,))
+        self._roles = {uid: role for uid, role in rows}
+
+    # --- Кэш ---
+    def role_of(self, user_id: int) -> str:
+        """Роль без обращения к БД."""
+        return self._roles.get(user_id, ROLE_CLIENT)
+
+    def with_role(self, role: str) -> set:
+        """user_id с заданной не-клиентской ролью — из памяти."""
+        return {uid for uid, r in self._roles.items() if r == role}
+
+    def cached_profile(self, user_id: int) -> Optional[UserProfile]:
+        profile = self._profiles.get(user_id)
+        if profile is not None: self._profiles.move_to_end(user_id)
+        return profile
+
+    def invalidate(self, user_id: int):
+        self._profiles.pop(user_id, None)
+
+    def _remember(self, profile: UserProfile):
+        self._profiles[profile.user_id] = profile
+        self._profiles.move_to_end(profile.user_id)
+        while len(self._profiles) > self._cache_size:
+            self._profiles.popitem(last=False)
+
+    def _patch(self, user_id: int, **fields):
+        profile = self._profiles.get(user_id)
+        if profile is not None: self._profiles[user_id] = profile._replace(**fields)
+
+    # --- Операции ---
+    async def touch_user(self, user_id: int, username: Optional[str], seen: Optional[int] = None):
+        """Регистрирует пользователя или обновляет username и время последнего визита (unix-время)."""
+        seen = int(time.time()) if seen is None else seen
+        await self._db.execute(_TOUCH, (user_id, username, seen))
+        self._patch(user_id, username=username)
+        self._seen(user_id, seen)
+
+    async def get_role(self, user_id: int) -> str:
+        return self.role_of(user_id)
+
+    async def set_role(self, user_id: int, role: str) -> bool:
+        changed = await self._db.execute(_SET_ROLE, (role, user_id)) > 0
+        if changed:
+            if role == ROLE_CLIENT: self._roles.pop(user_id, None)
+            else: self._roles[user_id] = role
+            self.invalidate(user_id)
+        return changed
+
+    async def get_profile(self, user_id: int) -> Optional[UserProfile]:
+        profile = self.cached_profile(user_id)
+        if profile is not None: return profile
+        row = await self._db.fetchone(_GET_PROFILE, (user_id,))
+        if not row: return None
+        profile = UserProfile(row[0], row[1], row[2] or ROLE_CLIENT, *row[3:])
+        self._remember(profile)
+        return profile
+
+    async def update_geo(self, user_id: int, geo: str, seen: int):
+        await self._db.execute(_UPDATE_GEO, (geo, seen, user_id))
+        self._patch(user_id, last_geo=geo)
+        self._seen(user_id, seen)
+
+    async def update_geo_many(self, items):
+        """Пакетное обновление позиций: items — [(user_id, geo, seen), ...], один executemany."""
+        await self._db.executemany(_UPDATE_GEO, [(geo, seen, uid) for uid, geo, seen in items])
+        for uid, geo, seen in items:
+            self._patch(uid, last_geo=geo)
+            self._seen(uid, seen)
+
+    async def last_positions(self) -> List[tuple]:
+        """[(user_id, last_geo, last_seen_at), ...] — для построения индекса автопарка при старте."""
+        return await self._db.fetchall(_POSITIONS)
+
+    async def google_updates(self, since: int) -> List[tuple]:
+        """[(user_id, last_google_update_at), ...] после since — для восстановления троттлинга Sheets после рестарта."""
+        return await self._db.fetchall(_GOOGLE_UPDATES, (since,))
+
+    async def set_google_update(self, user_id: int, ts: int):
+        await self._db.execute(_SET_GOOGLE_UPDATE, (ts, user_id))
+        self._patch(user_id, last_google_update=ts)
+
+    async def counters(self) -> Dict[str, int]:
+        """Счетчики, которые ведут триггеры: 'users', 'blocked', 'role:<роль>'."""
+        return dict(await self._db.fetchall(_COUNTERS))
+
+    async def count(self) -> int:
+        return (await self.counters()).get("users", 0)
+
+    async def seen_since(self, ts: int) -> List[tuple]:
+        """[(user_id, last_seen_at), ...] с визитом не раньше ts (по индексу) — для ActivityTracker при старте."""
+        return await self._db.fetchall(_SEEN_SINCE, (ts,))
+
+    async def recipients_page(self, after_id: int, limit: int) -> List[int]:
+        """Следующая страница получателей рассылки по ключу (user_id > after_id), без заблокировавших бота."""
+        return [r[0] for r in await self._db.fetchall(_RECIPIENTS, (after_id, limit))]
+
+    async def count_recipients(self) -> int:
+        c = await self.counters()
+        return c.get("users", 0) - c.get("blocked", 0)
+
+    async def mark_blocked(self, user_ids, ts: int):
+        """Бот заблокирован/чат удален — пропускаем в рассылках, пока пользователь снова не напишет."""
+        await self._db.executemany(_MARK_BLOCKED, [(ts, uid) for uid in user_ids])
+
+    def _seen(self, user_id: int, ts: int):
+        if self._activity is not None:
+            self._activity.seen(user_id, ts, driver=self.role_of(user_id) == ROLE_DRIVER)
+
+    async def recent_usernames(self, limit: int = 5) -> List[Optional[str]]:
+        return [r[0] for r in await self._db.fetchall(_RECENT, (limit,))]
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Запись в Google Sheets без блокировки event loop.
+
+Авторизация выполняется один раз, таблица и листы кэшируются, а все вызовы
+gspread уходят в пул потоков. Строки, поставленные в очередь в пределах
+короткого окна, объединяются в один append_rows на каждый лист.
+"""
+import asyncio
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+from google.oauth2.service_account import Credentials
+
+import metrics
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+
+
+class SheetsWriter:
+    """Долгоживущий писатель в одну таблицу Google Sheets."""
+
+    def __init__(self, sheet_id, creds_json, batch_window=0.5, max_batch=500, workers=2, timeout=30):
+        self._sheet_id = (sheet_id or "").strip()
+        self._creds_json = creds_json
+        self._batch_window = batch_window
+        self._max_batch = max_batch
+        self._timeout = timeout         # таймаут HTTP-запроса, чтобы зависший вызов не занимал поток навсегда
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gsheets")
+        self._lock = threading.Lock()   # защищает клиент и кэш листов (живут в потоках пула)
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}           # sheet_name -> Worksheet (None = первый лист)
+        self._pending = {}              # sheet_name -> [(row, future), ...]
+        self._flush_tasks = {}          # sheet_name -> отложенный flush (еще ждет окна пакета)
+        self._inflight = set()          # все запущенные flush — их дожидается flush() перед остановкой
+
+    @property
+    def configured(self) -> bool:
+        return bool(self._sheet_id and self._creds_json)
+
+    # --- Публичный async API ---
+    def append(self, row: list, sheet_name=None) -> asyncio.Future:
+        """Ставит строку в пакет. Возвращает future с True/False по итогу записи."""
+        fut = asyncio.get_running_loop().create_future()
+        if not self.configured:
+            fut.set_result(False)
+            return fut
+
+        batch = self._pending.setdefault(sheet_name, [])
+        batch.append((list(row), fut))
+        if len(batch) >= self._max_batch:
+            task = self._flush_tasks.pop(sheet_name, None)
+            if task: task.cancel()
+            self._track(asyncio.create_task(self._flush(sheet_name)))
+        elif sheet_name not in self._flush_tasks:
+            self._flush_tasks[sheet_name] = self._track(asyncio.create_task(self._flush_later(sheet_name)))
+        return fut
+
+    async def write_rows(self, rows: list, sheet_name=None):
+        """Пишет строки одним append_rows. Исключения gspread пробрасываются вызывающему."""
+        if not self.configured:
+            raise RuntimeError("Google Sheets не настроен (SHEET_ID / GOOGLE_CREDS_JSON)")
+        loop = asyncio.get_running_loop()
+        with metrics.timer("sheets_seconds", (("op", "append"),)):
+            return await loop.run_in_executor(self._executor, self._append_rows_sync, rows, sheet_name)
+
+    async def read_tail(self, sheet_name=None, count=200) -> list:
+        """Последние count непустых строк листа (значения — строки, без хвостовых пустых ячеек)."""
+        loop = asyncio.get_running_loop()
+        with metrics.timer("sheets_seconds", (("op", "read_tail"),)):
+            return await loop.run_in_executor(self._executor, self._read_tail_sync, sheet_name, count)
+
+    async def append_rows(self, rows: list, sheet_name=None) -> bool:
+        try:
+            await self.write_rows(rows, sheet_name)
+            return True
+        except Exception as e:
+            logging.error(f"GS Error: {e}")
+            return False
+
+    async def flush(self):
+        """Немедленно отправляет все накопленные пакеты и дожидается уже начатых записей (например, при остановке)."""
+        for task in self._flush_tasks.values():
+            task.cancel()
+        self._flush_tasks.clear()
+        await asyncio.gather(*(self._flush(name) for name in list(self._pending)),
+                             *self._inflight, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        self._executor.shutdown(wait=False)
+
+    # --- Внутреннее ---
+    def _track(self, task):
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        return task
+
+    async def _flush_later(self, sheet_name):
+        await asyncio.sleep(self._batch_window)
+        self._flush_tasks.pop(sheet_name, None)
+        await self._flush(sheet_name)
+
+    async def _flush(self, sheet_name):
+        batch = self._pending.pop(sheet_name, [])
+        if not batch: return
+        ok = await self.append_rows([row for row, _ in batch], sheet_name)
+        for _, fut in batch:
+            if not fut.done(): fut.set_result(ok)
+
+    def _worksheet(self, sheet_name):
+        with self._lock:
+            if self._client is None:
+                info = json.loads(self._creds_json)
+                creds = Credentials.from_service_account_info(info, scopes=SCOPES)
+                self._client = gspread.authorize(creds)
+                if hasattr(self._client, "set_timeout"):
+                    self._client.set_timeout(self._timeout)
+            if self._spreadsheet is None:
+                self._spreadsheet = self._client.open_by_key(self._sheet_id)
+            ws = self._worksheets.get(sheet_name)
+            if ws is None:
+                ss = self._spreadsheet
+                ws = ss.worksheet(sheet_name) if sheet_name else ss.get_worksheet(0)
+                self._worksheets[sheet_name] = ws
+            return ws
+
+    def _reset(self, sheet_name, full=False):
+        """Сбрасывает кэш после ошибки: при следующем вызове лист (и клиент) будут получены заново."""
+        with self._lock:
+            self._worksheets.pop(sheet_name, None)
+            if full:
+                self._worksheets.clear()
+                self._client = None
+                self._spreadsheet = None
+
+    def _append_rows_sync(self, rows, sheet_name):
+        try:
+            return self._worksheet(sheet_name).append_rows(rows)
+        except gspread.exceptions.WorksheetNotFound:
+            self._reset(sheet_name)
+            raise
+        except gspread.exceptions.APIError as e:
+            # 401/403/404 — протухший токен или удаленный лист: переоткрываем всё
+            if getattr(e.response, "status_code", None) in (401, 403, 404):
+                self._reset(sheet_name, full=True)
+            raise
+
+    def _read_tail_sync(self, sheet_name, count):
+        ws = self._worksheet(sheet_name)
+        last = len(ws.col_values(1))
+        if last == 0: return []
+        values = ws.get_values(f"{max(1, last - count + 1)}:{last}")
+        return [[str(c) for c in row] for row in values]
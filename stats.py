@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Агрегаты для админки, которые не пересчитываются запросом.
+
+ActivityTracker — кто был активен за последние часы: пользователь лежит в
+корзине часа своего последнего визита, «активны за N часов» — сумма
+размеров последних N корзин (не больше window_hours слагаемых, от размера
+users не зависит). Корзины старше окна выбрасываются вместе с их
+пользователями, так что в памяти только активные за неделю. Заполняется при
+старте одним запросом по индексу last_seen_at, дальше — из UserRepository.
+
+OrderStats — заказы по дням в таблице daily_orders (создает migrations.py):
+один UPSERT на заказ, чтение — несколько строк по первичному ключу.
+"""
+import time
+from datetime import date, timedelta
+from typing import Dict, Optional
+
+HOUR = 3600
+
+_ADD_ORDER = ("INSERT INTO daily_orders (day, orders) VALUES (?, 1) "
+              "ON CONFLICT(day) DO UPDATE SET orders=orders+1")
+_ORDERS_SINCE = "SELECT day, orders FROM daily_orders WHERE day>=?"
+
+
+class ActivityTracker:
+    def __init__(self, window_hours=168):
+        self._window = window_hours
+        self._hour_of: Dict[int, int] = {}       # user_id -> час последнего визита
+        self._buckets: Dict[int, set] = {}       # час -> {user_id}
+        self._drivers: Dict[int, set] = {}       # час -> {user_id} водителей
+        self._oldest = 0                         # корзины раньше этого часа уже выброшены
+
+    def load(self, rows, drivers=frozenset()):
+        """rows — [(user_id, last_seen_at), ...] за окно (users.seen_since)."""
+        for user_id, ts in rows:
+            if ts is not None:
+                self.seen(user_id, ts, driver=user_id in drivers)
+
+    def seen(self, user_id: int, ts: float, driver: bool = False):
+        hour = int(ts) // HOUR
+        self._expire(int(time.time()) // HOUR)
+        if hour < self._oldest: return
+        prev = self._hour_of.get(user_id)
+        if prev is not None:
+            if prev > hour: return          # пришло событие старше уже учтенного
+            self._buckets[prev].discard(user_id)
+            if prev in self._drivers: self._drivers[prev].discard(user_id)
+        self._hour_of[user_id] = hour
+        self._buckets.setdefault(hour, set()).add(user_id)
+        if driver: self._drivers.setdefault(hour, set()).add(user_id)
+
+    def active(self, hours: int, drivers: bool = False) -> int:
+        """Сколько пользователей (или водителей) было активно за последние hours часов."""
+        now = int(time.time()) // HOUR
+        self._expire(now)
+        buckets = self._drivers if drivers else self._buckets
+        return sum(len(buckets.get(h, ())) for h in range(now - min(hours, self._window) + 1, now + 1))
+
+    def _expire(self, now_hour: int):
+        cutoff = now_hour - self._window + 1
+        # Цикл идет по часам, а не по пользователям: после простоя в неделю — не больше window шагов
+        for hour in range(self._oldest, min(cutoff, self._oldest + self._window + 1)):
+            for user_id in self._buckets.pop(hour, ()):
+                if self._hour_of.get(user_id) == hour: del self._hour_of[user_id]
+            self._drivers.pop(hour, None)
+        if cutoff > self._oldest:
+            if cutoff - self._oldest > self._window:
+                # Простой дольше окна: все корзины устарели
+                self._buckets.clear(); self._drivers.clear(); self._hour_of.clear()
+            self._oldest = cutoff
+
+
+class OrderStats:
+    def __init__(self, db):
+        self._db = db
+
+    async def add(self, day: Optional[date] = None):
+        await self._db.execute(_ADD_ORDER, ((day or date.today()).isoformat(),))
+
+    async def last_days(self, days: int) -> Dict[str, int]:
+        """{'гггг-мм-дд': заказов} за последние days дней включая сегодня (дни без заказов отсутствуют)."""
+        since = (date.today() - timedelta(days=days - 1)).isoformat()
+        return dict(await self._db.fetchall(_ORDERS_SINCE, (since,)))
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный справочник ТН ВЭД: поиск кода и ставки пошлины без GPT.
+
+Набор кодов грузится из CSV (code;description;rate;keywords). По кодам
+строится префиксное дерево (ввод цифр, сопоставление кода из ответа AI с
+ближайшей позицией справочника), по описаниям и ключевым словам —
+инвертированный индекс по основам слов плюс триграммный индекс для опечаток.
+
+score совпадения — доля веса запроса, найденная в позиции, а не вероятность
+правильного кода: одно общее слово дает 1.0 сразу многим позициям. Поэтому
+решение «можно без AI» принимает confident(): кроме покрытия он требует,
+чтобы лидера не догоняли позиции другой товарной позиции или ставки.
+"""
+import csv
+import logging
+import math
+import os
+import re
+from collections import defaultdict
+from typing import List, NamedTuple, Optional
+
+_WORD = re.compile(r"[a-zа-я0-9]+")
+_CODE = re.compile(r"\b(\d{4}(?:\s?\d{2}){0,3})\b")
+STEM_LEN = 6
+# Служебные и слишком общие слова: совпадение по ним ничего не говорит о товаре
+STOPWORDS = frozenset({"для", "или", "без", "при", "как", "что", "это", "все", "под", "над", "про", "еще",
+                       "так", "также", "кроме", "прочие", "прочих", "прочий", "прочее", "других", "другие",
+                       "товар", "товары", "изделия", "изделие"})
+MAX_DF = 0.2        # слово есть в 20%+ позиций справочника — оно их не различает
+MIN_GAP = 0.15      # лидер должен опережать иную позицию/ставку хотя бы на столько
+
+
+class Tariff(NamedTuple):
+    code: str
+    description: str
+    rate: float
+
+
+class Match(NamedTuple):
+    score: float        # 0..1 — доля «веса» запроса, найденная в позиции
+    tariff: Tariff
+
+
+def _tokens(text: str):
+    return _WORD.findall(text.lower().replace("ё", "е"))
+
+
+def _terms(text: str):
+    """Значимые слова: без коротких и стоп-слов."""
+    return [t for t in _tokens(text) if len(t) >= 3 and t not in STOPWORDS]
+
+
+def _stem(token: str) -> str:
+    # Грубый, но быстрый стемминг: для русских окончаний хватает обрезки основы
+    return token[:STEM_LEN]
+
+
+def _trigrams(word: str):
+    w = f"  {word} "
+    return {w[i:i + 3] for i in range(len(w) - 2)}
+
+
+class TariffIndex:
+    def __init__(self, tariffs=()):
+        self._tariffs: List[Tariff] = []
+        self._trie = {}                          # цифра -> узел; ключ None — индексы позиций в узле
+        self._postings = defaultdict(set)        # основа -> {индекс позиции}
+        self._grams = defaultdict(set)           # триграмма -> {основа}
+        self._heads: List[str] = []              # основа первого слова описания (главное существительное)
+        for t in tariffs:
+            self.add(t)
+
+    @classmethod
+    def from_csv(cls, path: str) -> "TariffIndex":
+        index = cls()
+        if not os.path.exists(path):
+            logging.warning(f"Справочник ТН ВЭД не найден: {path}")
+            return index
+        with open(path, encoding="utf-8") as f:
+            for row in csv.DictReader(f, delimiter=";"):
+                try:
+                    tariff = Tariff(re.sub(r"\D", "", row["code"]), row["description"].strip(),
+                                    float(row["rate"].replace(",", ".")))
+                except (KeyError, ValueError, AttributeError):
+                    continue
+                index.add(tariff, row.get("keywords") or "")
+        return index
+
+    def __len__(self):
+        return len(self._tariffs)
+
+    def add(self, tariff: Tariff, keywords: str = ""):
+        i = len(self._tariffs)
+        self._tariffs.append(tariff)
+        head = _terms(tariff.description)
+        self._heads.append(_stem(head[0]) if head else "")
+        node = self._trie
+        for ch in tariff.code:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, []).append(i)
+        for tok in _terms(f"{tariff.description} {keywords}"):
+            stem = _stem(tok)
+            if stem not in self._postings:
+                for g in _trigrams(stem):
+                    self._grams[g].add(stem)
+            self._postings[stem].add(i)
+
+    # --- Коды ---
+    def by_prefix(self, prefix: str, limit: int = 10) -> List[Tariff]:
+        """Позиции, код которых начинается с prefix (в порядке кодов)."""
+        node = self._trie
+        for ch in re.sub(r"\D", "", prefix):
+            node = node.get(ch)
+            if node is None: return []
+        return self._collect(node, limit)
+
+    def closest(self, code: str) -> Optional[Tariff]:
+        """Позиция с самым длинным общим префиксом кода (не короче 4 знаков — товарная позиция)."""
+        node, depth, best = self._trie, 0, None
+        for ch in re.sub(r"\D", "", code):
+            node = node.get(ch)
+            if node is None: break
+            depth += 1
+            if depth >= 4:
+                best = node
+        if best is None: return None
+        hits = self._collect(best, 1)
+        return hits[0] if hits else None
+
+    def _collect(self, node, limit):
+        found, stack = [], [node]
+        while stack and len(found) < limit:
+            node = stack.pop()
+            found += [self._tariffs[i] for i in node.get(None, ())]
+            stack += [node[k] for k in sorted((k for k in node if k is not None), reverse=True)]
+        return found[:limit]
+
+    def get(self, code: str) -> Optional[Tariff]:
+        hits = self.by_prefix(code, 1)
+        return hits[0] if hits and hits[0].code == code else None
+
+    # --- Текст ---
+    def _similar_stems(self, stem: str, min_sim: float = 0.4):
+        """Основы из словаря, похожие на stem по Жаккару триграмм (опечатки, другие окончания)."""
+        grams = _trigrams(stem)
+        counts = defaultdict(int)
+        for g in grams:
+            for other in self._grams.get(g, ()):
+                counts[other] += 1
+        result = []
+        for other, common in counts.items():
+            sim = common / (len(grams) + len(_trigrams(other)) - common)
+            if sim >= min_sim:
+                result.append((other, sim))
+        return result
+
+    def search(self, query: str, limit: int = 3) -> List[Match]:
+        """Позиции по названию товара; score 1.0 — все значимые слова запроса найдены точно."""
+        digits = re.sub(r"\D", "", query)
+        if len(digits) >= 4 and len(digits) * 2 >= len(query.replace(" ", "")):
+            return [Match(1.0, t) for t in self.by_prefix(digits, limit)]
+
+        n = len(self._tariffs)
+        # Слово из большой доли справочника не различает позиции — в счет не идет
+        stems = {s for s in (_stem(t) for t in _terms(query)) if len(self._postings.get(s, ())) <= MAX_DF * n}
+        if not stems or not self._tariffs: return []
+        scores = defaultdict(float)
+        total = 0.0
+        for stem in stems:
+            matches = [(stem, 1.0)] if stem in self._postings else [
+                (s, sim) for s, sim in self._similar_stems(stem) if len(self._postings[s]) <= MAX_DF * n]
+            # Вес слова — idf лучшего совпадения: «аккумуляторы» важнее «для»
+            idf = max((math.log(1 + n / len(self._postings[s])) for s, _ in matches), default=math.log(1 + n))
+            total += idf
+            best = {}
+            for s, sim in matches:
+                for i in self._postings[s]:
+                    best[i] = max(best.get(i, 0.0), sim)
+            for i, sim in best.items():
+                scores[i] += idf * sim
+        # При равном счете выше позиция, где слово запроса — главное в описании
+        # («аккумуляторы» -> «Аккумуляторы ...», а не «Зарядные устройства для аккумуляторов»)
+        ranked = sorted(scores.items(), key=lambda kv: (-kv[1], self._heads[kv[0]] not in stems,
+                                                        self._tariffs[kv[0]].code))[:limit]
+        return [Match(round(s / total, 3), self._tariffs[i]) for i, s in ranked]
+
+    def confident(self, query: str, threshold: float) -> bool:
+        """Лучшее совпадение можно брать без AI: покрытие не ниже threshold и никто из другой
+        товарной позиции (первые 4 знака) или с другой ставкой не идет вровень с лидером."""
+        matches = self.search(query, limit=len(self._tariffs))
+        if not matches or matches[0].score < threshold: return False
+        top = matches[0]
+        for m in matches[1:]:
+            if top.score - m.score >= MIN_GAP: break
+            if m.tariff.code[:4] != top.tariff.code[:4] or m.tariff.rate != top.tariff.rate:
+                return False
+        return True
+
+    def find_in_text(self, text: str) -> Optional[Tariff]:
+        """Первый код из свободного текста (например, ответа AI), сопоставленный со справочником."""
+        for m in _CODE.finditer(text or ""):
+            tariff = self.closest(m.group(1).replace(" ", ""))
+            if tariff: return tariff
+        return None
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+История GPS-треков водителей.
+
+Точки копятся в открытом сегменте каждого водителя в памяти. Сегмент
+закрывается по числу точек, возрасту или разрыву во времени (новый рейс),
+упрощается Дугласом–Пекером и ложится в positions одной BLOB-строкой:
+lat/lon в int32 с фиксированной точкой 1e-6 и смещение времени от начала
+сегмента в секундах — 12 байт на точку. Стоянка не плодит точек: пока
+водитель в пределах min_move_m, обновляется только «хвост» с последним временем.
+"""
+import asyncio
+import logging
+import math
+import struct
+import time
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS positions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    t_start INTEGER NOT NULL,
+    t_end INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    data BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_positions_user_end ON positions(user_id, t_end);'''
+
+_INSERT = "INSERT INTO positions (user_id, t_start, t_end, n, data) VALUES (?, ?, ?, ?, ?)"
+_SELECT = "SELECT t_start, data FROM positions WHERE user_id=? AND t_end>=? AND t_start<=? ORDER BY t_start"
+
+SCALE = 1_000_000
+EARTH_R = 6371000.0
+
+
+def encode(points) -> bytes:
+    """[(ts, lat, lon), ...] -> BLOB: по три int32 на точку, время — от первой точки."""
+    t0 = int(points[0][0])
+    flat = []
+    for ts, lat, lon in points:
+        flat += (round(lat * SCALE), round(lon * SCALE), int(ts) - t0)
+    return struct.pack(f"<{len(flat)}i", *flat)
+
+
+def decode(t_start: int, blob: bytes):
+    vals = struct.unpack(f"<{len(blob) // 4}i", blob)
+    return [(t_start + vals[i + 2], vals[i] / SCALE, vals[i + 1] / SCALE) for i in range(0, len(vals), 3)]
+
+
+def haversine_m(lat1, lon1, lat2, lon2) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_R * math.asin(math.sqrt(a))
+
+
+def simplify(points, epsilon_m: float):
+    """Дуглас–Пекер (итеративно) в локальной равнопромежуточной проекции, допуск в метрах."""
+    if len(points) < 3: return list(points)
+    k = math.cos(math.radians(points[0][1]))
+    xy = [(math.radians(lon) * k * EARTH_R, math.radians(lat) * EARTH_R) for _, lat, lon in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        a, b = stack.pop()
+        (ax, ay), (bx, by) = xy[a], xy[b]
+        dx, dy = bx - ax, by - ay
+        norm = math.hypot(dx, dy)
+        best, idx = 0.0, -1
+        for i in range(a + 1, b):
+            px, py = xy[i]
+            d = abs(dy * (px - ax) - dx * (py - ay)) / norm if norm else math.hypot(px - ax, py - ay)
+            if d > best: best, idx = d, i
+        if best > epsilon_m:
+            keep[idx] = True
+            stack += [(a, idx), (idx, b)]
+    return [p for p, k_ in zip(points, keep) if k_]
+
+
+def track_length_m(points) -> float:
+    return sum(haversine_m(a[1], a[2], b[1], b[2]) for a, b in zip(points, points[1:]))
+
+
+class _Segment:
+    __slots__ = ("points", "tail", "opened", "carried")
+
+    def __init__(self, point, carried=False):
+        self.points = [point]
+        self.tail = None        # последняя точка стоянки (еще не зафиксирована)
+        self.opened = time.monotonic()
+        self.carried = carried  # первая точка уже сохранена как конец предыдущего сегмента
+
+    @property
+    def has_new(self) -> bool:
+        return len(self.points) > 1 or self.tail is not None or not self.carried
+
+
+class TrackStore:
+    def __init__(self, db, min_move_m=25.0, epsilon_m=30.0, max_points=500,
+                 max_age=1800.0, gap=1800.0, flush_interval=60.0):
+        self._db = db
+        self._min_move = min_move_m
+        self._epsilon = epsilon_m
+        self._max_points = max_points
+        self._max_age = max_age              # открытый сегмент не живет в памяти дольше (потеря при падении)
+        self._gap = gap                      # пауза больше — новый рейс/сегмент
+        self._flush_interval = flush_interval
+        self._open = {}                      # user_id -> _Segment
+
+    def init_schema(self):
+        self._db.execute_script(SCHEMA)
+
+    def add(self, user_id: int, lat: float, lon: float, ts: float = None):
+        """Точка от водителя. O(1), запись в БД только при закрытии сегмента."""
+        point = (int(ts or time.time()), lat, lon)
+        seg = self._open.get(user_id)
+        if seg is None:
+            self._open[user_id] = _Segment(point)
+            return
+        last = seg.tail or seg.points[-1]
+        if point[0] - last[0] > self._gap:
+            self._close(user_id)
+            self._open[user_id] = _Segment(point)
+            return
+        anchor = seg.points[-1]
+        if haversine_m(anchor[1], anchor[2], lat, lon) < self._min_move:
+            seg.tail = point
+            return
+        if seg.tail: seg.points.append(seg.tail)
+        seg.tail = None
+        seg.points.append(point)
+        if len(seg.points) >= self._max_points:
+            self._close(user_id, reopen=True)
+
+    def _close(self, user_id, reopen=False):
+        seg = self._open.pop(user_id, None)
+        if seg is None or not seg.has_new: return
+        points = seg.points + ([seg.tail] if seg.tail else [])
+        if reopen:
+            # Новый сегмент начинается с последней точки — трек остается непрерывным
+            self._open[user_id] = _Segment(points[-1], carried=True)
+        points = simplify(points, self._epsilon)
+        blob = encode(points)
+        fut = self._db.execute(_INSERT, (user_id, points[0][0], points[-1][0], len(points), blob))
+        fut.add_done_callback(_log_failure)
+
+    async def flush(self, force=False):
+        """Закрывает сегменты старше max_age (или все при force) и дожидается записи."""
+        now = time.monotonic()
+        for user_id, seg in list(self._open.items()):
+            if seg.has_new and (force or now - seg.opened >= self._max_age):
+                self._close(user_id, reopen=not force)
+        await self._db.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Track flush error: {e}")
+
+    async def track(self, user_id: int, t_from: float, t_to: float):
+        """Точки трека [(ts, lat, lon), ...] за интервал, включая еще не закрытый сегмент."""
+        rows = await self._db.fetchall(_SELECT, (user_id, int(t_from), int(t_to)))
+        points = []
+        for t_start, blob in rows:
+            points += decode(t_start, blob)
+        seg = self._open.get(user_id)
+        if seg:
+            points += seg.points + ([seg.tail] if seg.tail else [])
+        points = [p for p in points if t_from <= p[0] <= t_to]
+        # Соседние сегменты стыкуются общей точкой — убираем дубли
+        return [p for i, p in enumerate(points) if i == 0 or p != points[i - 1]]
+
+
+def _log_failure(fut):
+    if not fut.cancelled() and fut.exception():
+        logging.error(f"Track save error: {fut.exception()}")
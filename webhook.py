@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Режим webhook: aiohttp-сервер поверх интеграции aiogram.
+
+Telegram присылает апдейты POST-запросом; ответ 200 уходит сразу, а апдейт
+обрабатывается фоновой задачей. Задач одновременно не больше max_tasks —
+сверх лимита и во время остановки отвечаем 503, и Telegram повторит
+доставку позже (в том числе на другую реплику за балансировщиком).
+Секрет из заголовка X-Telegram-Bot-Api-Secret-Token сверяется за
+постоянное время (secrets.compare_digest внутри aiogram).
+
+Остановка: /readyz сразу отдает 503, новые апдейты отклоняются, уже
+начатые хендлеры дорабатывают (до drain_timeout), и только потом вызывающий
+сбрасывает буферы и закрывает БД. /healthz — живость процесса и задержка
+event loop: фоновый тикер засыпает на LAG_INTERVAL и замеряет, насколько
+позже проснулся. /metrics на публичный порт webhook не вешаем — его отдает
+отдельный слушатель metrics.serve (METRICS_PORT), как и в polling.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import metrics
+
+LAG_INTERVAL = 0.5      # период тикера задержки event loop, с
+
+
+def derive_secret(bot_token: str) -> str:
+    """Секрет webhook, одинаковый на всех репликах без отдельной настройки (A-Z, a-z, 0-9)."""
+    return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher, bot, max_tasks=200, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._max_tasks = max_tasks
+        self.draining = False
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _handle_request_background(self, bot, request):
+        if self.draining or self.in_flight >= self._max_tasks:
+            self.rejected += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        self.accepted += 1
+        return await super()._handle_request_background(bot, request)
+
+    async def drain(self, timeout: float):
+        """Перестает принимать апдейты и ждет уже запущенные хендлеры."""
+        self.draining = True
+        tasks = list(self._background_feed_update_tasks)
+        if not tasks: return
+        logging.info(f"Webhook: waiting for {len(tasks)} handlers")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logging.warning(f"Webhook: {len(pending)} handlers cancelled after {timeout}s")
+            for task in pending: task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def close(self):
+        # Сессию бота закрывает main после сброса буферов (рассылке и отчетам она еще нужна)
+        pass
+
+
+class WebhookServer:
+    def __init__(self, dp, bot, url: str, path="/webhook", host="0.0.0.0", port=8080,
+                 secret=None, max_tasks=200, drain_timeout=25.0):
+        self.dp = dp
+        self.bot = bot
+        self.url = url.rstrip("/") + path
+        self._host, self._port = host, port
+        self._secret = secret or derive_secret(bot.token)
+        self._drain_timeout = drain_timeout
+        self.handler = BoundedRequestHandler(dp, bot, max_tasks=max_tasks, secret_token=self._secret)
+        self.app = web.Application()
+        self.handler.register(self.app, path=path)
+        setup_application(self.app, dp, bot=bot)
+        self.app.router.add_get("/healthz", self._healthz)
+        self.app.router.add_get("/readyz", self._readyz)
+        self._runner = None
+        self._lag_task = None
+        self.loop_lag = 0.0     # последняя замеренная задержка event loop, с
+        self.ready = False
+
+    async def _watch_loop_lag(self):
+        """Насколько sleep(LAG_INTERVAL) просыпается позже срока — столько ждет и любой хендлер."""
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.loop_lag = max(0.0, time.perf_counter() - t - LAG_INTERVAL)
+            metrics.observe("loop_lag_seconds", (), self.loop_lag)
+
+    async def _healthz(self, request):
+        # Ответ вообще пришел — event loop жив; задержку меряет тикер, а не этот запрос
+        return web.json_response({"status": "ok", "loop_lag_ms": round(self.loop_lag * 1000, 2)})
+
+    async def _readyz(self, request):
+        ok = self.ready and not self.handler.draining
+        return web.json_response({"ready": ok, "in_flight": self.handler.in_flight,
+                                  "accepted": self.handler.accepted, "rejected": self.handler.rejected},
+                                 status=200 if ok else 503)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, handle_signals=False)
+        await self._runner.setup()
+        self._lag_task = asyncio.create_task(self._watch_loop_lag())
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        await self.bot.set_webhook(self.url, secret_token=self._secret,
+                                   allowed_updates=self.dp.resolve_used_update_types(),
+                                   max_connections=100)
+        self.ready = True
+        logging.info(f"Webhook: listening on {self._host}:{self._port}, url {self.url}")
+
+    async def stop(self):
+        """Снимает реплику с балансировки и дожидается начатых хендлеров.
+
+        Webhook в Telegram не удаляем: перезапуск или соседние реплики продолжат прием.
+        """
+        self.ready = False
+        await self.handler.drain(self._drain_timeout)
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            await asyncio.gather(self._lag_task, return_exceptions=True)
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None